@@ -1,6 +1,4 @@
 import numpy as np
-from astropy import units as u
-from astropy.coordinates import SkyCoord
 import glob
 import sys
 import matplotlib
@@ -10,10 +8,13 @@ matplotlib.use("TkAgg") # must be before pyplot
 import matplotlib.pyplot as plt
 import math
 import os
+import warnings
+
+from astropy.stats import sigma_clip
 
 import logging
 
-from astrosource.utils import photometry_files_to_array, AstrosourceException
+from astrosource.utils import photometry_files_to_array, radec_to_xyz, match_xyz, image_trees, match_comparisons, AstrosourceException
 
 logger = logging.getLogger(__name__)
 
@@ -41,37 +42,24 @@ def calculate_curves(targets, acceptDistance=10.0, errorReject=0.05, parentPath
     minimumNoOfObs=10 # Minimum number of observations to count as a potential variable.
 
 
-    # Load in list of used files
-    fileList=[]
-    with open(parentPath / "usedImages.txt", "r") as f:
-      for line in f:
-        fileList.append(line.strip())
-
-    # LOAD Phot FILES INTO LIST
-    photFileArray=[]
-    for file in fileList:
-        photFileArray.append(np.genfromtxt(file, dtype=float, delimiter=','))
-    photFileArray=np.asarray(photFileArray)
+    photFileArray, offsets, fileList = photometry_files_to_array(parentPath)
+    nImages = len(fileList)
 
     # LOAD IN COMPARISON FILE
-    preFile = np.genfromtxt(parentPath / 'stdComps.csv', dtype=float, delimiter=',')
+    preFile = np.loadtxt(parentPath / 'stdComps.csv', dtype=np.float64, delimiter=',', ndmin=2)
 
     logger.debug(preFile.shape)
-    if preFile.shape[0] !=13:
-        preFile=(preFile[preFile[:,2].argsort()])
+    preFile=(preFile[preFile[:,2].argsort()])
 
     # GET REFERENCE IMAGE
     # Sort through and find the largest file and use that as the reference file
-    fileSizer=0
     logger.debug("Finding image with most stars detected")
-    for imgs in range(photFileArray.shape[0]):
-        photFile = photFileArray[imgs]
-        if photFile.size > fileSizer:
-            referenceFrame=photFile
-            logger.debug(photFile.size)
-            fileSizer=photFile.size
-
-    compFile=np.genfromtxt(parentPath / "compsUsed.csv", dtype=float, delimiter=',')
+    fileSizes = np.diff(offsets)
+    referenceImage = fileSizes.argmax()
+    referenceFrame = photFileArray[offsets[referenceImage]:offsets[referenceImage+1]]
+    logger.debug(fileSizes.max())
+
+    compFile=np.loadtxt(parentPath / "compsUsed.csv", dtype=np.float64, delimiter=',', ndmin=2)
     logger.debug("Stable Comparison Candidates below variability threshold")
     outputPhot=[]
 
@@ -79,32 +67,16 @@ def calculate_curves(targets, acceptDistance=10.0, errorReject=0.05, parentPath
 
     fileCount=[]
     compArray=[]
-    allCountsArray=[]
-
-    for imgs in range(photFileArray.shape[0]):
-        allCounts=0.0
-        allCountsErr=0.0
-        photFile = photFileArray[imgs]
-        fileRaDec = SkyCoord(ra=photFile[:,0]*u.degree, dec=photFile[:,1]*u.degree)
-        #Array of comp measurements
-        logger.debug("***************************************")
-        logger.debug("Calculating total Comparison counts for")
-        logger.debug(fileList[imgs])
-
-        logger.debug(compFile.shape)
-        #logger.debug"Calculating total counts"
-        for j in range(compFile.shape[0]):
-            if compFile.size == 2 or (compFile.shape[0]== 3 and compFile.size ==3) or (compFile.shape[0]== 5 and compFile.size ==5):
-                matchCoord=SkyCoord(ra=compFile[0]*u.degree, dec=compFile[1]*u.degree)
-            else:
-                matchCoord=SkyCoord(ra=compFile[j][0]*u.degree, dec=compFile[j][1]*u.degree)
-            idx, d2d, d3d = matchCoord.match_to_catalog_sky(fileRaDec)
-            allCounts=allCounts+photFile[idx][4]
-            allCountsErr=allCountsErr+photFile[idx][5]
-            if (compFile.shape[0]== 5 and compFile.size ==5) or (compFile.shape[0]== 3 and compFile.size ==3):
-                break
 
-        allCountsArray.append([allCounts,allCountsErr])
+    # KD-tree of the stars in each image, built once and reused for every match
+    fileTrees = image_trees([photFileArray[offsets[i]:offsets[i+1]] for i in range(nImages)])
+    # Row of each comparison star in each image within the stacked photometry
+    compRows = offsets[:-1,np.newaxis] + match_comparisons(compFile, fileTrees)
+    logger.debug(compFile.shape)
+
+    # Total comparison counts and error in each image
+    allCountsArray = photFileArray[compRows,4:6].sum(axis=1)
+    logTotal = np.log10(allCountsArray[:,0])
 
     logger.debug(allCountsArray)
 
@@ -112,194 +84,157 @@ def calculate_curves(targets, acceptDistance=10.0, errorReject=0.05, parentPath
     logger.debug("Setting up Variable Search List")
     targetFile=referenceFrame
     # Although remove stars that are below the variable countrate
-    starReject=[]
-    for q in range(targetFile.shape[0]):
-        if targetFile[q][4] < minimumVariableCounts:
-            starReject.append(q)
     logger.debug("Total number of stars in reference Frame: {}".format(targetFile.shape[0]))
-    targetFile=np.delete(targetFile, starReject, axis=0)
+    targetFile=targetFile[targetFile[:,4] >= minimumVariableCounts]
     logger.debug("Total number of stars with sufficient counts: {}".format(targetFile.shape[0]))
 
     ## NEED TO REMOVE COMPARISON STARS FROM TARGETLIST
 
-    allcountscount=0
+    # Differential magnitude of every target in every image, NaN where there is no usable measurement
+    targetRows=np.empty((targetFile.shape[0], nImages), dtype=np.intp)
+    targetMatched=np.empty((targetFile.shape[0], nImages), dtype=bool)
+    targetXyz=radec_to_xyz(targetFile[:,0], targetFile[:,1])
+    for imgs in range(nImages):
+        idx, sep = match_xyz(targetXyz, fileTrees[imgs], workers=-1)
+        targetRows[:,imgs] = offsets[imgs] + idx
+        targetMatched[:,imgs] = sep < acceptDistance
+    with np.errstate(divide='ignore', invalid='ignore'):
+        diffMags = -2.5*(np.log10(photFileArray[targetRows,4]) - logTotal)
+    diffMags[~(targetMatched & np.isfinite(diffMags))] = np.nan
+
+    ## REMOVE MAJOR OUTLIERS FROM CONSIDERATION
+    varMedian, varStd, varObs = variability_statistics(diffMags)
+
     # For each variable calculate the variability
     outputVariableHolder=[]
+    targetRa, targetDec = targetFile[:,0], targetFile[:,1]
     for q in range(targetFile.shape[0]):
         logger.debug("*********************")
         logger.debug("Processing Target {}".format(str(q+1)))
-        logger.debug("RA {}".format(targetFile[q][0]))
-        logger.debug("DEC {}".format(targetFile[q][1]))
-        varCoord = SkyCoord(targetFile[q][0],(targetFile[q][1]), frame='icrs', unit=u.deg) # Need to remove target stars from consideration
-        outputPhot=[]
-        compArray=[]
-        compList=[]
-
-        diffMagHolder=[]
-
-        allcountscount=0
-
-        for imgs in range(photFileArray.shape[0]):
-            compList=[]
-            photFile = photFileArray[imgs]
-
-            fileRaDec = SkyCoord(ra=photFile[:,0]*u.degree, dec=photFile[:,1]*u.degree)
-
-            idx, d2d, d3d = varCoord.match_to_catalog_sky(fileRaDec)
-            if (np.less(d2d.arcsecond, acceptDistance) and ((np.multiply(-2.5,np.log10(np.divide(photFile[idx][4],allCountsArray[allcountscount][0])))) != np.inf )):
-
-                diffMagHolder=np.append(diffMagHolder,(np.multiply(-2.5,np.log10(np.divide(photFile[idx][4],allCountsArray[allcountscount][0])))))
-            allcountscount=np.add(allcountscount,1)
-
+        logger.debug("RA {}".format(targetRa[q]))
+        logger.debug("DEC {}".format(targetDec[q]))
+        logger.debug("Standard Deviation in mag: {}".format(varStd[q]))
+        logger.debug("Median Magnitude: {}".format(varMedian[q]))
+        logger.debug("Number of Observations: {}".format(varObs[q]))
 
-        ## REMOVE MAJOR OUTLIERS FROM CONSIDERATION
-        while True:
-            stdVar=np.std(diffMagHolder)
-            avgVar=np.average(diffMagHolder)
-            starReject=[]
-            z=0
-            for j in range(np.asarray(diffMagHolder).shape[0]):
-                if diffMagHolder[j] > avgVar+(4*stdVar) or diffMagHolder[j] < avgVar-(4*stdVar) :
-                    starReject.append(j)
-                    logger.debug("REJECT {}".format(diffMagHolder[j]))
-                    z=1
-            diffMagHolder=np.delete(diffMagHolder, starReject, axis=0)
-            if z==0:
-                break
-
-
-        logger.debug("Standard Deviation in mag: {}".format(np.std(diffMagHolder)))
-        logger.debug("Median Magnitude: {}".format(np.median(diffMagHolder)))
-        logger.debug("Number of Observations: {}".format(np.asarray(diffMagHolder).shape[0]))
-
-        if (  np.asarray(diffMagHolder).shape[0] > minimumNoOfObs):
-            outputVariableHolder.append( [targetFile[q][0],targetFile[q][1],np.median(diffMagHolder), np.std(diffMagHolder), np.asarray(diffMagHolder).shape[0]])
+        if (varObs[q] > minimumNoOfObs):
+            outputVariableHolder.append( [targetRa[q],targetDec[q],varMedian[q], varStd[q], varObs[q]])
 
     np.savetxt(parentPath / "starVariability.csv", outputVariableHolder, delimiter=",", fmt='%0.8f')
 
     return outputVariableHolder
 
+def variability_statistics(diffMags, sigma=4):
+    '''
+    Reject outliers from each row of a targets x images array of magnitudes,
+    repeating until no more are rejected, and summarise what remains.
+    NaN entries are missing measurements.
+
+    Returns
+    -------
+    median, std, nobs : arrays
+        Median, standard deviation and number of remaining measurements for each row
+    '''
+    with warnings.catch_warnings():
+        # Targets with no measurements give all-NaN rows
+        warnings.simplefilter("ignore")
+        diffMags = sigma_clip(diffMags, sigma=sigma, maxiters=None, cenfunc='mean', stdfunc='std', axis=1, masked=False)
+        return np.nanmedian(diffMags, axis=1), np.nanstd(diffMags, axis=1), np.count_nonzero(~np.isnan(diffMags), axis=1)
+
 def photometric_calculations(targets, paths, acceptDistance=10.0, errorReject=0.5):
 
-    photFileArray, fileList = photometry_files_to_array(paths['parent'])
+    photFileArray, offsets, fileList = photometry_files_to_array(paths['parent'])
+    nImages = len(fileList)
+
+    # Observation date and airmass are encoded in each photometry file name
+    fileNames = [Path(file).name.split("_") for file in fileList]
+    fileDates = np.array([float(name[5].replace("d",".")) for name in fileNames])
+    fileAirmasses = np.array([float(name[4].replace("a",".")) for name in fileNames])
 
     if (paths['parent'] / 'calibCompsUsed.csv').exists():
         logger.debug("Calibrated")
-        compFile=np.genfromtxt(paths['parent'] / 'calibCompsUsed.csv', dtype=float, delimiter=',')
+        compFile=np.loadtxt(paths['parent'] / 'calibCompsUsed.csv', dtype=np.float64, delimiter=',', ndmin=2)
         calibFlag=1
     else:
         logger.debug("Differential")
-        compFile=np.genfromtxt(paths['parent'] / 'compsUsed.csv', dtype=float, delimiter=',')
+        compFile=np.loadtxt(paths['parent'] / 'compsUsed.csv', dtype=np.float64, delimiter=',', ndmin=2)
         calibFlag=0
 
     # Get total counts for each file
     fileCount=[]
     compArray=[]
-    allCountsArray=[]
-    for imgs in range(photFileArray.shape[0]):
-        allCounts=0.0
-        allCountsErr=0.0
-        photFile = photFileArray[imgs]
-        fileRaDec = SkyCoord(ra=photFile[:,0]*u.degree, dec=photFile[:,1]*u.degree)
-        logger.debug("Calculating total Comparison counts for : {}".format(fileList[imgs]))
-        #logger.debug(compFile.shape[0])
-
-        if compFile.shape[0]== 5 and compFile.size ==5:
-            loopLength=1
-        else:
-            loopLength=compFile.shape[0]
-        #logger.debug(compFile.size)
-                    #sys.exit()
-        for j in range(loopLength):
-            if compFile.size == 2 or (compFile.shape[0]== 5 and compFile.size ==5):
-    ##
-    ##    for j in range(compFile.shape[0]):
-    ##        if compFile.size == 2 or compFile.shape[0] == 5:
-                matchCoord=SkyCoord(ra=compFile[0]*u.degree, dec=compFile[1]*u.degree)
-            else:
-                matchCoord=SkyCoord(ra=compFile[j][0]*u.degree, dec=compFile[j][1]*u.degree)
-            idx, d2d, d3d = matchCoord.match_to_catalog_sky(fileRaDec)
-            allCounts=np.add(allCounts,photFile[idx][4])
-            allCountsErr=np.add(allCountsErr,photFile[idx][5])
 
-        allCountsArray.append([allCounts,allCountsErr])
+    # KD-tree of the stars in each image, built once and reused for every match
+    fileTrees = image_trees([photFileArray[offsets[i]:offsets[i+1]] for i in range(nImages)])
+    # Row of each comparison star in each image within the stacked photometry, the same for every target
+    compRows = offsets[:-1,np.newaxis] + match_comparisons(compFile, fileTrees)
+
+    # Total comparison counts and error in each image
+    allCountsArray = photFileArray[compRows,4:6].sum(axis=1)
+    logTotal = np.log10(allCountsArray[:,0])
+    compCounts = photFileArray[compRows,4]
+    # Non-positive counts give a NaN or infinite magnitude rather than stopping the run
+    with np.errstate(divide='ignore', invalid='ignore'):
+        logCounts = np.log10(photFileArray[:,4])
+    allCounts, allCountsErr = allCountsArray[-1]
 
     logger.debug(allCountsArray)
 
+    magErrEns = 1.0857 * (allCountsErr/allCounts)
+
     allcountscount=0
 
-    if len(targets)== 4:
-        loopLength=1
-    else:
-        loopLength=targets.shape[0]
+    # Each output row holds the target's photometry row, date, airmass, ensemble counts and error,
+    # differential magnitude and error, target counts and error, then the counts of each comparison
+    outputColumns=photFileArray.shape[1] + 8 + compFile.shape[0]
+
+    # Target positions are pulled out once, a single target is treated as a one row list
+    targetCoords=np.atleast_2d(np.asarray(targets, dtype=np.float64))[:,:2]
+    targetXyz=radec_to_xyz(targetCoords[:,0], targetCoords[:,1])
     # For each variable calculate all the things
-    for q in range(loopLength):
+    for q in range(targetCoords.shape[0]):
         starErrorRejCount=0
         starDistanceRejCount=0
+        varRa, varDec = targetCoords[q]
         logger.debug("****************************")
         logger.debug("Processing Variable {}".format(q+1))
-        if int(len(targets)) == 4:
-            logger.debug("RA {}".format(targets[0]))
-        else:
-            logger.debug("RA {}".format(targets[q][0]))
-        if int(len(targets)) == 4:
-            logger.debug("Dec {}".format(targets[1]))
-        else:
-            logger.debug("Dec {}".format(targets[q][1]))
-        if int(len(targets)) == 4:
-            varCoord = SkyCoord(targets[0],(targets[1]), frame='icrs', unit=u.deg) # Need to remove target stars from consideration
-        else:
-            varCoord = SkyCoord(targets[q][0],(targets[q][1]), frame='icrs', unit=u.deg) # Need to remove target stars from consideration
+        logger.debug("RA {}".format(varRa))
+        logger.debug("Dec {}".format(varDec))
 
         # Grabbing variable rows
         logger.debug("Extracting and Measuring Differential Magnitude in each Photometry File")
-        outputPhot=[] # new
+        outputPhot=np.full((nImages, outputColumns), np.nan)
         compArray=[]
         compList=[]
         allcountscount=0
-        for imgs in range(photFileArray.shape[0]):
+        for imgs in range(nImages):
             compList=[]
-            fileRaDec = SkyCoord(ra=photFileArray[imgs][:,0]*u.degree, dec=photFileArray[imgs][:,1]*u.degree)
-            idx, d2d, _ = varCoord.match_to_catalog_sky(fileRaDec)
+            fileTree = fileTrees[imgs]
+            idx, sep = match_xyz(targetXyz[q], fileTree)
+            row = offsets[imgs] + idx
             starRejected=0
-            if (np.less(d2d.arcsecond, acceptDistance)):
-                magErrVar = 1.0857 * (photFileArray[imgs][idx][5]/photFileArray[imgs][idx][4])
+            if sep < acceptDistance:
+                varCounts, varCountsErr = photFileArray[row,4:6]
+                magErrVar = 1.0857 * (varCountsErr/varCounts)
                 if magErrVar < errorReject:
 
-                    magErrEns = 1.0857 * (allCountsErr/allCounts)
-                    magErrTotal = pow( pow(magErrVar,2) + pow(magErrEns,2),0.5)
+                    magErrTotal = math.hypot(magErrVar, magErrEns)
 
                     #templist is a temporary holder of the resulting file.
-                    tempList=photFileArray[imgs][idx,:]
-                    googFile = Path(fileList[imgs]).name
-                    tempList=np.append(tempList, float(googFile.split("_")[5].replace("d",".")))
-                    tempList=np.append(tempList, float(googFile.split("_")[4].replace("a",".")))
-                    tempList=np.append(tempList, allCountsArray[allcountscount][0])
-                    tempList=np.append(tempList, allCountsArray[allcountscount][1])
+                    tempList=list(photFileArray[row,:])
+                    tempList.extend([fileDates[imgs],
+                                     fileAirmasses[imgs],
+                                     allCountsArray[allcountscount][0],
+                                     allCountsArray[allcountscount][1]])
 
                     #Differential Magnitude
-                    tempList=np.append(tempList, 2.5 * np.log10(allCountsArray[allcountscount][0]/photFileArray[imgs][idx][4]))
-                    tempList=np.append(tempList, magErrTotal)
-                    tempList=np.append(tempList, photFileArray[imgs][idx][4])
-                    tempList=np.append(tempList, photFileArray[imgs][idx][5])
-
-
-
-                    if (compFile.shape[0]== 5 and compFile.size ==5) or (compFile.shape[0]== 3 and compFile.size ==3):
-                        loopLength=1
-                    else:
-                        loopLength=compFile.shape[0]
-                    #logger.debug(compFile.size)
-                    #sys.exit()
-                    for j in range(loopLength):
-                        if compFile.size == 2 or (compFile.shape[0]== 3 and compFile.size ==3) or (compFile.shape[0]== 5 and compFile.size ==5):
-                            matchCoord=SkyCoord(ra=compFile[0]*u.degree, dec=compFile[1]*u.degree)
-                        else:
-                            matchCoord=SkyCoord(ra=compFile[j][0]*u.degree, dec=compFile[j][1]*u.degree)
-                        idx, d2d, d3d = matchCoord.match_to_catalog_sky(fileRaDec)
-                        tempList=np.append(tempList, photFileArray[imgs][idx][4])
-
-                    outputPhot.append(tempList)
+                    tempList.extend([2.5 * (logTotal[allcountscount] - logCounts[row]),
+                                     magErrTotal,
+                                     varCounts,
+                                     varCountsErr])
+                    tempList.extend(compCounts[imgs])
+
+                    outputPhot[imgs]=tempList
                     fileCount.append(allCounts)
                     allcountscount=allcountscount+1
 
@@ -313,53 +248,32 @@ def photometric_calculations(targets, paths, acceptDistance=10.0, errorReject=0.
             if ( starRejected == 1):
 
                     #templist is a temporary holder of the resulting file.
-                    tempList=photFileArray[imgs][idx,:]
-                    googFile = Path(fileList[imgs]).name
-                    tempList=np.append(tempList, float(googFile.split("_")[5].replace("d",".")))
-                    tempList=np.append(tempList, float(googFile.split("_")[4].replace("a",".")))
-                    tempList=np.append(tempList, allCountsArray[allcountscount][0])
-                    tempList=np.append(tempList, allCountsArray[allcountscount][1])
+                    tempList=list(photFileArray[row,:])
+                    tempList.extend([fileDates[imgs],
+                                     fileAirmasses[imgs],
+                                     allCountsArray[allcountscount][0],
+                                     allCountsArray[allcountscount][1]])
 
                     #Differential Magnitude
-                    tempList=np.append(tempList,np.nan)
-                    tempList=np.append(tempList,np.nan)
-                    tempList=np.append(tempList, photFileArray[imgs][idx][4])
-                    tempList=np.append(tempList, photFileArray[imgs][idx][5])
-
-
-                    if (compFile.shape[0]== 5 and compFile.size ==5) or (compFile.shape[0]== 3 and compFile.size ==3):
-                        loopLength=1
-                    else:
-                        loopLength=compFile.shape[0]
-                    #logger.debug(compFile.shape[0])
-                    #sys.exit()
-                    for j in range(loopLength):
-                        if compFile.size == 2 or (compFile.shape[0]== 3 and compFile.size ==3) or (compFile.shape[0]== 5 and compFile.size ==5):
-                            matchCoord=SkyCoord(ra=compFile[0]*u.degree, dec=compFile[1]*u.degree)
-                        else:
-                            matchCoord=SkyCoord(ra=compFile[j][0]*u.degree, dec=compFile[j][1]*u.degree)
-                        idx, d2d, d3d = matchCoord.match_to_catalog_sky(fileRaDec)
-                        tempList=np.append(tempList, photFileArray[imgs][idx][4])
-                    outputPhot.append(tempList)
+                    tempList.extend([np.nan,
+                                     np.nan,
+                                     photFileArray[row,4],
+                                     photFileArray[row,5]])
+                    tempList.extend(compCounts[imgs])
+
+                    outputPhot[imgs]=tempList
                     fileCount.append(allCounts)
                     allcountscount=allcountscount+1
 
         # Check for dud images
-        imageReject=[]
-        for j in range(np.asarray(outputPhot).shape[0]):
-            if np.isnan(outputPhot[j][11]):
-                imageReject.append(j)
-        outputPhot=np.delete(outputPhot, imageReject, axis=0)
+        outputPhot=outputPhot[~np.isnan(outputPhot[:,11])]
 
         ## REMOVE MAJOR OUTLIERS FROM CONSIDERATION
-        stdVar=np.nanstd(np.asarray(outputPhot)[:,10])
-        avgVar=np.nanmean(np.asarray(outputPhot)[:,10])
-        starReject=[]
-        stdevReject=0
-        for j in range(np.asarray(outputPhot).shape[0]):
-            if outputPhot[j][10] > avgVar+(4*stdVar) or outputPhot[j][10] < avgVar-(4*stdVar) :
-                starReject.append(j)
-                stdevReject=stdevReject+1
+        diffMags=outputPhot[:,10]
+        stdVar=np.nanstd(diffMags)
+        avgVar=np.nanmean(diffMags)
+        starReject=np.ma.getmaskarray(sigma_clip(diffMags, sigma=4, maxiters=1, cenfunc='mean', stdfunc='std', masked=True))
+        stdevReject=np.count_nonzero(starReject)
 
         logger.info("Rejected Stdev Measurements: : {}".format(stdevReject))
         logger.info("Rejected Error Measurements: : {}".format(starErrorRejCount))
@@ -368,7 +282,7 @@ def photometric_calculations(targets, paths, acceptDistance=10.0, errorReject=0.
         logger.info("Average : {}".format(avgVar))
         logger.info("Stdev   : {}".format(stdVar))
 
-        outputPhot=np.delete(outputPhot, starReject, axis=0)
+        outputPhot=outputPhot[~starReject]
         if outputPhot.shape[0] > 2:
             np.savetxt(os.path.join(paths['outcatPath'],"doerPhot_V" +str(q+1) +".csv"), outputPhot, delimiter=",", fmt='%0.8f')
             logger.debug('Saved doerPhot_V')
@@ -1,6 +1,9 @@
 import glob
 import sys
 import os
+import hashlib
+import pickle
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import numpy as np
@@ -11,14 +14,14 @@ from astroquery.vo_conesearch import ConeSearch
 from astroquery.vizier import Vizier
 
 
-from astrosource.utils import AstrosourceException
+from astrosource.utils import read_photometry_file, radec_to_xyz, sky_tree, match_radec, match_xyz, stars_within, image_trees, match_comparisons, AstrosourceException
 
 import logging
 
 logger = logging.getLogger(__name__)
 
 
-def find_comparisons(parentPath=None, stdMultiplier=3, thresholdCounts=1000000000, variabilityMultiplier=2.5, removeTargets=1, acceptDistance=5.0):
+def find_comparisons(parentPath=None, stdMultiplier=3, thresholdCounts=1000000000, variabilityMultiplier=2.5, removeTargets=1, acceptDistance=5.0, cache=None):
     '''
     Find stable comparison stars for the target photometry
 
@@ -36,6 +39,9 @@ def find_comparisons(parentPath=None, stdMultiplier=3, thresholdCounts=100000000
             Set this to 1 to remove targets from consideration for comparison stars
     acceptDistance : float
             Furthest distance in arcseconds for matches
+    cache : dict
+            If given, filled with the loaded photometry and the comparison lists so that
+            find_comparisons_calibrated can reuse them instead of reading the files again
 
     Returns
     -------
@@ -50,6 +56,8 @@ def find_comparisons(parentPath=None, stdMultiplier=3, thresholdCounts=100000000
         parentPath = Path(parentPath)
 
     compFile, photFileArray, fileList = read_data_files(parentPath)
+    # KD-tree of the stars in each image, built once and reused on every pass
+    photTrees = image_trees(photFileArray)
 
     if removeTargets == 1:
         targetFile = remove_targets(parentPath, compFile, acceptDistance)
@@ -59,12 +67,14 @@ def find_comparisons(parentPath=None, stdMultiplier=3, thresholdCounts=100000000
         # To create a gigantic comparison star.
 
         logger.debug("Please wait... calculating ensemble comparison star for each image")
-        fileCount = ensemble_comparisons(photFileArray, compFile)
+        # The comparison stars are matched once per pass and shared by both halves of the loop
+        compIdx = match_comparisons(compFile, photTrees)
+        fileCount = ensemble_comparisons(photFileArray, compFile, photTrees, compIdx)
 
         # Second half of Loop: Calculate the variation in each candidate comparison star in brightness
         # compared to this gigantic comparison star.
         rejectStar=[]
-        stdCompStar, sortStars = calculate_comparison_variation(compFile, photFileArray, fileCount)
+        stdCompStar, sortStars = calculate_comparison_variation(compFile, photFileArray, fileCount, photTrees, compIdx)
         variabilityMax=(np.min(stdCompStar)*variabilityMultiplier)
 
         # Calculate and present the sample statistics
@@ -73,26 +83,16 @@ def find_comparisons(parentPath=None, stdMultiplier=3, thresholdCounts=100000000
 
         logger.debug(fileCount)
         logger.debug(stdCompStar)
-        logger.debug(np.median(stdCompStar))
-        logger.debug(np.std(stdCompStar))
+        logger.debug(stdCompMed)
+        logger.debug(stdCompStd)
 
-        # Delete comparisons that have too high a variability
-        starRejecter=[]
-        for j in range(len(stdCompStar)):
-            logger.debug(stdCompStar[j])
-            if ( stdCompStar[j] > (stdCompMed + (stdMultiplier*stdCompStd)) ):
-                logger.debug("Star Rejected, Variability too high!")
-                starRejecter.append(j)
+        # Delete comparisons that have too high a variability or an invalid entry
+        starReject = (stdCompStar > (stdCompMed + (stdMultiplier*stdCompStd))) | np.isnan(stdCompStar)
+        if starReject.any():
+            logger.warning("Rejected {} stars".format(np.count_nonzero(starReject)))
 
-            if ( np.isnan(stdCompStar[j]) ) :
-                logger.debug("Star Rejected, Invalid Entry!")
-                starRejecter.append(j)
-        if starRejecter:
-            logger.warning("Rejected {} stars".format(len(starRejecter)))
-
-
-        compFile = np.delete(compFile, starRejecter, axis=0)
-        sortStars = np.delete(sortStars, starRejecter, axis=0)
+        compFile = compFile[~starReject]
+        sortStars = sortStars[~starReject]
 
         # Calculate and present statistics of sample of candidate comparison stars.
         logger.info("Median variability {:.6f}".format(np.median(stdCompStar)))
@@ -101,174 +101,124 @@ def find_comparisons(parentPath=None, stdMultiplier=3, thresholdCounts=100000000
         logger.info("Max variability {:.6f}".format(np.max(stdCompStar)))
         logger.info("Number of Stable Comparison Candidates {}".format(compFile.shape[0]))
         # Once we have stopped rejecting stars, this is our final candidate catalogue then we start to select the subset of this final catalogue that we actually use.
-        if (starRejecter == []):
+        if not starReject.any():
             break
         else:
             logger.warning("Trying again")
 
     logger.info('Statistical stability reached.')
-    outfile, num_comparisons = final_candidate_catalogue(parentPath, photFileArray, sortStars, thresholdCounts, variabilityMax)
+    outfile, num_comparisons = final_candidate_catalogue(parentPath, photFileArray, sortStars, thresholdCounts, variabilityMax, cache)
+    if cache is not None:
+        cache.update({'parent': parentPath, 'fileList': fileList, 'photFileArray': photFileArray, 'photTrees': photTrees})
     return outfile, num_comparisons
 
-def final_candidate_catalogue(parentPath, photFileArray, sortStars, thresholdCounts, variabilityMax):
+def final_candidate_catalogue(parentPath, photFileArray, sortStars, thresholdCounts, variabilityMax, cache=None):
 
     logger.info('List of stable comparison candidates output to stdComps.csv')
 
     np.savetxt(parentPath / "stdComps.csv", sortStars, delimiter=",", fmt='%0.8f')
+    if cache is not None:
+        cache['stdComps'] = sortStars
 
     # The following process selects the subset of the candidates that we will use (the least variable comparisons that hopefully get the request countrate)
 
     # Sort through and find the largest file and use that as the reference file
-    referenceFrame, fileRaDec = find_reference_frame(photFileArray)
+    referenceFrame = find_reference_frame(photFileArray)
+    referenceTree = sky_tree(referenceFrame[:,0], referenceFrame[:,1])
 
     # SORT THE COMP CANDIDATE FILE such that least variable comparison is first
     sortStars=(sortStars[sortStars[:,2].argsort()])
 
     # PICK COMPS UNTIL OVER THE THRESHOLD OF COUNTS OR VRAIABILITY ACCORDING TO REFERENCE IMAGE
     logger.debug("PICK COMPARISONS UNTIL OVER THE THRESHOLD ACCORDING TO REFERENCE IMAGE")
-    compFile=[]
-    tempCountCounter=0.0
-    finalCountCounter=0.0
-    for j in range(sortStars.shape[0]):
-        matchCoord=SkyCoord(ra=sortStars[j][0]*u.degree, dec=sortStars[j][1]*u.degree)
-        idx, d2d, d3d = matchCoord.match_to_catalog_sky(fileRaDec)
-        tempCountCounter=np.add(tempCountCounter,referenceFrame[idx][4])
-
-        if tempCountCounter < thresholdCounts:
-            if sortStars[j][2] < variabilityMax:
-                compFile.append([sortStars[j][0],sortStars[j][1],sortStars[j][2]])
-                logger.debug("Comp " + str(j+1) + " std: " + str(sortStars[j][2]))
-                logger.debug("Cumulative Counts thus far: " + str(tempCountCounter))
-                finalCountCounter=np.add(finalCountCounter,referenceFrame[idx][4])
+    idx, sep = match_radec(sortStars[:,0], sortStars[:,1], referenceTree)
+    counts = referenceFrame[idx,4]
+    # Running total of counts over every candidate in order of variability
+    cumulativeCounts = np.cumsum(counts)
+    selected = (cumulativeCounts < thresholdCounts) & (sortStars[:,2] < variabilityMax)
+    compFile = sortStars[selected,:3]
+    finalCountCounter = counts[selected].sum()
 
     logger.debug("Selected stars listed below:")
     logger.debug(compFile)
 
     logger.info("Finale Ensemble Counts: " + str(finalCountCounter))
-    compFile=np.asarray(compFile)
 
     logger.info(str(compFile.shape[0]) + " Stable Comparison Candidates below variability threshold output to compsUsed.csv")
     #logger.info(compFile.shape[0])
 
     outfile = parentPath / "compsUsed.csv"
     np.savetxt(outfile, compFile, delimiter=",", fmt='%0.8f')
+    if cache is not None:
+        cache['compsUsed'] = compFile
 
     return outfile, compFile.shape[0]
 
 def find_reference_frame(photFileArray):
-    fileSizer = 0
     logger.info("Finding image with most stars detected")
-    for photFile in photFileArray:
-        if photFile.size > fileSizer:
-            referenceFrame = photFile
-            logger.debug(photFile.size)
-            fileSizer = photFile.size
-    logger.info("Setting up reference Frame")
-    fileRaDec = SkyCoord(ra=referenceFrame[:,0]*u.degree, dec=referenceFrame[:,1]*u.degree)
-    return referenceFrame, fileRaDec
+    fileSizes = np.array([photFile.size for photFile in photFileArray])
+    referenceFrame = photFileArray[fileSizes.argmax()]
+    logger.debug(fileSizes.max())
+    return referenceFrame
 
 def read_data_files(parentPath):
     fileList=[]
     for line in (parentPath / "usedImages.txt").read_text().strip().split('\n'):
         fileList.append(line.strip())
 
-    # LOAD Phot FILES INTO LIST
-
-    photFileArray = []
-    for file in fileList:
-        photFileArray.append(np.genfromtxt(file, dtype=float, delimiter=','))
-    photFileArray = np.asarray(photFileArray)
+    # LOAD Phot FILES INTO LIST, files have different numbers of stars so this stays a list of arrays
+    photFileArray = [read_photometry_file(file) for file in fileList]
 
 
     #Grab the candidate comparison stars
     screened_file = parentPath / "screenedComps.csv"
-    compFile = np.genfromtxt(screened_file, dtype=float, delimiter=',')
+    compFile = np.atleast_2d(np.genfromtxt(screened_file, dtype=float, delimiter=','))
     return compFile, photFileArray, fileList
 
-def ensemble_comparisons(photFileArray, compFile):
-    fileCount=[]
-    for photFile in photFileArray:
-        allCounts=0.0
-        fileRaDec = SkyCoord(ra=photFile[:,0]*u.degree, dec=photFile[:,1]*u.degree)
-        for cf in compFile:
-            matchCoord = SkyCoord(ra=cf[0]*u.degree, dec=cf[1]*u.degree)
-            idx, d2d, d3d = matchCoord.match_to_catalog_sky(fileRaDec)
-            allCounts = np.add(allCounts,photFile[idx][4])
-
-
-        logger.debug("Total Counts in Image: {:.2f}".format(allCounts))
-        fileCount=np.append(fileCount, allCounts)
+def ensemble_comparisons(photFileArray, compFile, photTrees=None, compIdx=None):
+    if compIdx is None:
+        compIdx = match_comparisons(compFile, photTrees if photTrees is not None else image_trees(photFileArray))
+    fileCount=np.empty(len(photFileArray))
+    for imgs, photFile in enumerate(photFileArray):
+        fileCount[imgs]=photFile[compIdx[imgs],4].sum()
     return fileCount
 
-def calculate_comparison_variation(compFile, photFileArray, fileCount):
-    stdCompStar=[]
-    sortStars=[]
-
-    for cf in compFile:
-        compDiffMags = []
-        q=0
-        logger.debug("*************************")
-        logger.debug("RA : " + str(cf[0]))
-        logger.debug("DEC: " + str(cf[1]))
-        for imgs in range(photFileArray.shape[0]):
-            photFile = photFileArray[imgs]
-            fileRaDec = SkyCoord(ra=photFile[:,0]*u.degree, dec=photFile[:,1]*u.degree)
-            matchCoord = SkyCoord(ra=cf[0]*u.degree, dec=cf[1]*u.degree)
-            idx, d2d, d3d = matchCoord.match_to_catalog_sky(fileRaDec)
-            compDiffMags = np.append(compDiffMags,2.5 * np.log10(photFile[idx][4]/fileCount[q]))
-            q = np.add(q,1)
-
-        logger.debug("VAR: " +str(np.std(compDiffMags)))
-        stdCompStar.append(np.std(compDiffMags))
-        sortStars.append([cf[0],cf[1],np.std(compDiffMags),0.0,0.0,0.0,0.0,0.0,0.0,0.0,0.0,0.0,0.0])
+def calculate_comparison_variation(compFile, photFileArray, fileCount, photTrees=None, compIdx=None):
+    if compIdx is None:
+        compIdx = match_comparisons(compFile, photTrees if photTrees is not None else image_trees(photFileArray))
+    # Counts of every comparison star (rows) in every image (columns)
+    compCounts = np.empty((compFile.shape[0], len(photFileArray)))
+    for imgs, photFile in enumerate(photFileArray):
+        compCounts[:,imgs] = photFile[compIdx[imgs],4]
+
+    compDiffMags = 2.5 * np.log10(compCounts/fileCount)
+    stdCompStar = np.std(compDiffMags, axis=1)
+    sortStars = np.zeros((compFile.shape[0], 13))
+    sortStars[:,0] = compFile[:,0]
+    sortStars[:,1] = compFile[:,1]
+    sortStars[:,2] = stdCompStar
     return stdCompStar, sortStars
 
 def remove_targets(parentPath, compFile, acceptDistance):
-    max_sep=acceptDistance * u.arcsec
     logger.info("Removing Target Stars from potential Comparisons")
-    targetFile = np.genfromtxt(parentPath / 'targetstars.csv', dtype=float, delimiter=',')
-    fileRaDec = SkyCoord(ra=compFile[:,0]*u.degree, dec=compFile[:,1]*u.degree)
+    targetFile = np.atleast_2d(np.genfromtxt(parentPath / 'targetstars.csv', dtype=float, delimiter=','))
+    fileTree = sky_tree(compFile[:,0], compFile[:,1])
     # Remove any nan rows from targetFile
-    targetRejecter=[]
-    if not (targetFile.shape[0] == 4 and targetFile.size ==4):
-        for z in range(targetFile.shape[0]):
-          if np.isnan(targetFile[z][0]):
-            targetRejecter.append(z)
-        targetFile=np.delete(targetFile, targetRejecter, axis=0)
+    targetFile=targetFile[~np.isnan(targetFile[:,0])]
 
     # Remove targets from consideration
-    if len(targetFile)== 4:
-        loopLength=1
-    else:
-        loopLength=targetFile.shape[0]
-    targetRejects=[]
-    tg_file_len = len(targetFile)
-    for tf in targetFile:
-        if tg_file_len == 4:
-            varCoord = SkyCoord(targetFile[0],(targetFile[1]), frame='icrs', unit=u.deg)
-        else:
-            varCoord = SkyCoord(tf[0],(tf[1]), frame='icrs', unit=u.deg) # Need to remove target stars from consideration
-        idx, d2d, _ = varCoord.match_to_catalog_sky(fileRaDec)
-        if d2d.arcsecond < acceptDistance:
-            targetRejects.append(idx)
-        if tg_file_len == 4:
-            break
-    compFile=np.delete(compFile, idx, axis=0)
+    keep=np.ones(compFile.shape[0], dtype=bool)
+    keep[stars_within(targetFile[:,0], targetFile[:,1], fileTree, acceptDistance)]=False
 
     # Get Average RA and Dec from file
-    if compFile.shape[0] == 13:
-        logger.debug(compFile[0])
-        logger.debug(compFile[1])
-        avgCoord=SkyCoord(ra=(compFile[0])*u.degree, dec=(compFile[1]*u.degree))
-
-    else:
-        logger.debug(np.average(compFile[:,0]))
-        logger.debug(np.average(compFile[:,1]))
-        avgCoord=SkyCoord(ra=(np.average(compFile[:,0]))*u.degree, dec=(np.average(compFile[:,1]))*u.degree)
+    avgRa, avgDec = np.average(compFile[keep,0]), np.average(compFile[keep,1])
+    logger.debug(avgRa)
+    logger.debug(avgDec)
+    avgCoord=SkyCoord(ra=avgRa << u.deg, dec=avgDec << u.deg)
 
 
     # Check VSX for any known variable stars and remove them from the list
-    variableResult=Vizier.query_region(avgCoord, '0.33 deg', catalog='VSX')['B/vsx/vsx']
+    variableResult=query_vizier(parentPath, avgCoord, 'VSX', 'B/vsx/vsx')
 
     logger.debug(variableResult)
 
@@ -284,24 +234,11 @@ def remove_targets(parentPath, compFile, acceptDistance):
     decCat=variableSearchResult[:,1]
     logger.debug(decCat)
 
-    varStarReject=[]
-    for t in range(raCat.size):
-      logger.debug(raCat[t])
-      compCoord=SkyCoord(ra=raCat[t]*u.degree, dec=decCat[t]*u.degree)
-      logger.debug(compCoord)
-      catCoords=SkyCoord(ra=compFile[:,0]*u.degree, dec=compFile[:,1]*u.degree)
-      idxcomp,d2dcomp,d3dcomp=compCoord.match_to_catalog_sky(catCoords)
-      logger.debug(d2dcomp)
-      if d2dcomp *u.arcsecond < max_sep*u.arcsecond:
-        logger.debug("match!")
-        varStarReject.append(t)
-      else:
-        logger.debug("no match!")
-
-
+    # Any comparison star that is a known variable is rejected
     logger.debug("Number of stars prior to VSX reject")
-    logger.debug(compFile.shape[0])
-    compFile=np.delete(compFile, varStarReject, axis=0)
+    logger.debug(np.count_nonzero(keep))
+    keep[stars_within(raCat, decCat, fileTree, acceptDistance)]=False
+    compFile=compFile[keep]
     logger.debug("Number of stars post to VSX reject")
     logger.debug(compFile.shape[0])
 
@@ -316,7 +253,28 @@ def remove_targets(parentPath, compFile, acceptDistance):
         raise AstrosourceException("Looks like you have a single comparison star!")
     return compFile
 
-def find_comparisons_calibrated(filterCode, paths=None, max_magerr=0.05, stdMultiplier=2, variabilityMultiplier=2, panStarrsInstead=False):
+def query_vizier(parentPath, coord, catalog, table, radius='0.33 deg'):
+    '''
+    Vizier.query_region for one catalogue table, cached on disk in parentPath
+    so that repeated runs on the same field do not query the network again
+
+    The cache is keyed on the catalogue, table, field centre to 0.001 degrees,
+    search radius and Vizier row limit
+    '''
+    key = "{} {} {:.3f} {:.3f} {} {}".format(catalog, table, coord.ra.degree, coord.dec.degree, radius, Vizier.ROW_LIMIT)
+    cacheFile = parentPath / "catalogcache" / "{}.pkl".format(hashlib.md5(key.encode()).hexdigest())
+    if cacheFile.exists():
+        logger.debug("Using cached {} query".format(catalog))
+        with open(cacheFile, 'rb') as f:
+            return pickle.load(f)
+
+    result = Vizier.query_region(coord, radius=radius, catalog=catalog)[table]
+    cacheFile.parent.mkdir(exist_ok=True)
+    with open(cacheFile, 'wb') as f:
+        pickle.dump(result, f)
+    return result
+
+def find_comparisons_calibrated(filterCode, paths=None, max_magerr=0.05, stdMultiplier=2, variabilityMultiplier=2, panStarrsInstead=False, cache=None):
 
     parentPath = paths['parent']
     calibPath = parentPath / "calibcats"
@@ -324,40 +282,39 @@ def find_comparisons_calibrated(filterCode, paths=None, max_magerr=0.05, stdMult
         os.makedirs(calibPath)
 
     Vizier.ROW_LIMIT = -1
-    max_sep=1.0 * u.arcsec
+    max_sep=1.0 # arcseconds
+
+    # Reuse the files loaded by find_comparisons for this directory if they were cached
+    cached = bool(cache) and cache.get('parent') == parentPath
 
     # Get List of Files Used
-    fileList=[]
-    for line in (parentPath / "usedImages.txt").read_text().strip().split('\n'):
-        fileList.append(line.strip())
+    if cached:
+        fileList=cache['fileList']
+    else:
+        fileList=[]
+        for line in (parentPath / "usedImages.txt").read_text().strip().split('\n'):
+            fileList.append(line.strip())
 
     logger.debug("Filter Set: " + filterCode)
 
     # Load compsused
-    compFile = np.genfromtxt(parentPath / 'stdComps.csv', dtype=float, delimiter=',')
-    logger.debug(compFile.shape[0])
-
-    if compFile.shape[0] == 13:
-        compCoords=SkyCoord(ra=compFile[0]*u.degree, dec=compFile[1]*u.degree)
+    if cached:
+        compFile = cache['stdComps']
     else:
-        compCoords=SkyCoord(ra=compFile[:,0]*u.degree, dec=compFile[:,1]*u.degree)
+        compFile = np.atleast_2d(np.genfromtxt(parentPath / 'stdComps.csv', dtype=float, delimiter=','))
+    logger.debug(compFile.shape[0])
 
     # Get Average RA and Dec from file
-    if compFile.shape[0] == 13:
-        logger.debug(compFile[0])
-        logger.debug(compFile[1])
-        avgCoord=SkyCoord(ra=(compFile[0])*u.degree, dec=(compFile[1]*u.degree))
-
-    else:
-        logger.debug(np.average(compFile[:,0]))
-        logger.debug(np.average(compFile[:,1]))
-        avgCoord=SkyCoord(ra=(np.average(compFile[:,0]))*u.degree, dec=(np.average(compFile[:,1]))*u.degree)
+    avgRa, avgDec = np.average(compFile[:,0]), np.average(compFile[:,1])
+    logger.debug(avgRa)
+    logger.debug(avgDec)
+    avgCoord=SkyCoord(ra=avgRa << u.deg, dec=avgDec << u.deg)
 
     # get results from internetz
 
     if filterCode=='B' or filterCode=='V':
         #collect APASS results
-        apassResult=Vizier.query_region(avgCoord, '0.33 deg', catalog='APASS')['II/336/apass9']
+        apassResult=query_vizier(parentPath, avgCoord, 'APASS', 'II/336/apass9')
 
         logger.debug(apassResult)
         apassResult=apassResult.to_pandas()
@@ -442,7 +399,7 @@ def find_comparisons_calibrated(filterCode, paths=None, max_magerr=0.05, stdMult
         elif panStarrsInstead and filterCode!='up':
             logger.debug("Panstarrs!")
 
-            sdssResult=Vizier.query_region(avgCoord, '0.33 deg', catalog='PanStarrs')['II/349/ps1']
+            sdssResult=query_vizier(parentPath, avgCoord, 'PanStarrs', 'II/349/ps1')
             logger.debug(sdssResult)
             logger.debug(sdssResult.keys())
 
@@ -488,7 +445,7 @@ def find_comparisons_calibrated(filterCode, paths=None, max_magerr=0.05, stdMult
 
         else:
             logger.debug("goodo lets do the sdss stuff then.")
-            sdssResult=Vizier.query_region(avgCoord, '0.33 deg', catalog='SDSS')['V/147/sdss12']
+            sdssResult=query_vizier(parentPath, avgCoord, 'SDSS', 'V/147/sdss12')
             logger.debug(sdssResult)
             logger.debug(sdssResult.keys())
 
@@ -531,34 +488,14 @@ def find_comparisons_calibrated(filterCode, paths=None, max_magerr=0.05, stdMult
                 logger.debug(emagCat)
 
     #Setup standard catalogue coordinates
-    catCoords=SkyCoord(ra=raCat*u.degree, dec=decCat*u.degree)
+    catTree=sky_tree(raCat, decCat)
 
 
     #Get calib mags for least variable IDENTIFIED stars.... not the actual stars in compUsed!! Brighter, less variable stars may be too bright for calibration!
     #So the stars that will be used to calibrate the frames to get the OTHER stars.
-    calibStands=[]
-    if compFile.shape[0] ==13:
-        lenloop=1
-    else:
-        lenloop=len(compFile[:,0])
-    for q in range(lenloop):
-        if compFile.shape[0] ==13:
-            compCoord=SkyCoord(ra=compFile[0]*u.degree, dec=compFile[1]*u.degree)
-        else:
-            compCoord=SkyCoord(ra=compFile[q][0]*u.degree, dec=compFile[q][1]*u.degree)
-        idxcomp,d2dcomp,d3dcomp=compCoord.match_to_catalog_sky(catCoords)
-
-        if d2dcomp *u.arcsecond < max_sep*u.arcsecond:
-            if not np.isnan(magCat[idxcomp]):
-                #logger.debug(idxcomp)
-                #logger.debug(d2dcomp)
-                #logger.debug(magCat[idxcomp])
-                #logger.debug(emagCat[idxcomp])
-
-                if compFile.shape[0] ==13:
-                    calibStands.append([compFile[0],compFile[1],compFile[2],magCat[idxcomp],emagCat[idxcomp]])
-                else:
-                    calibStands.append([compFile[q][0],compFile[q][1],compFile[q][2],magCat[idxcomp],emagCat[idxcomp]])
+    idxcomp,sepcomp=match_radec(compFile[:,0], compFile[:,1], catTree)
+    matched=(sepcomp < max_sep) & ~np.isnan(magCat[idxcomp])
+    calibStands=np.column_stack([compFile[matched,:3], magCat[idxcomp[matched]], emagCat[idxcomp[matched]]])
 
     # Get the set of least variable stars to use as a comparison to calibrate the files (to eventually get the *ACTUAL* standards
     #logger.debug(np.asarray(calibStands).shape[0])
@@ -573,79 +510,34 @@ def find_comparisons_calibrated(filterCode, paths=None, max_magerr=0.05, stdMult
     #logger.debug(np.asarray(calibStands)[:,2])
     logger.debug(varimin)
 
-    calibStandsReject=[]
-    for q in range(len(np.asarray(calibStands)[:,0])):
-        if calibStands[q][2] > varimin:
-            calibStandsReject.append(q)
-            #logger.debug(calibStands[q][2])
-
-    calibStands=np.delete(calibStands, calibStandsReject, axis=0)
+    calibStands=calibStands[calibStands[:,2] <= varimin]
 
     calibStand=np.asarray(calibStands)
 
     np.savetxt(parentPath / "calibStands.csv", calibStands , delimiter=",", fmt='%0.8f')
     # Lets use this set to calibrate each datafile and pull out the calibrated compsused magnitudes
-    compUsedFile = np.genfromtxt(parentPath / 'compsUsed.csv', dtype=float, delimiter=',')
+    if cached:
+        compUsedFile = cache['compsUsed']
+        photFileArray, photTrees = cache['photFileArray'], cache['photTrees']
+    else:
+        compUsedFile = np.atleast_2d(np.genfromtxt(parentPath / 'compsUsed.csv', dtype=float, delimiter=','))
+        photFileArray = photTrees = [None] * len(fileList)
 
-    calibCompUsed=[]
+    # Calibrated magnitude of each used comparison (columns) in each file (rows)
+    calibCompUsed=np.empty((len(fileList), compUsedFile.shape[0]))
+    calibXyz=radec_to_xyz(calibStand[:,0], calibStand[:,1])
+    compUsedXyz=radec_to_xyz(compUsedFile[:,0], compUsedFile[:,1])
 
     logger.debug("CALIBRATING EACH FILE")
-    for file in fileList:
-
-        logger.debug(file)
-
-        #Get the phot file into memory
-        photFile = np.genfromtxt(parentPath / file, dtype=float, delimiter=',')
-        photCoords=SkyCoord(ra=photFile[:,0]*u.degree, dec=photFile[:,1]*u.degree)
-
-        #Convert the phot file into instrumental magnitudes
-        for r in range(len(photFile[:,0])):
-            photFile[r,5]=1.0857 * (photFile[r,5]/photFile[r,4])
-            photFile[r,4]=-2.5*np.log10(photFile[r,4])
-
-        #Pull out the CalibStands out of each file
-        tempDiff=[]
-        for q in range(len(calibStands[:,0])):
-            calibCoord=SkyCoord(ra=calibStand[q][0]*u.degree,dec=calibStand[q][1]*u.degree)
-            idx,d2d,d3d=calibCoord.match_to_catalog_sky(photCoords)
-            tempDiff.append(calibStand[q,3]-photFile[idx,4])
-
-        #logger.debug(tempDiff)
-        tempZP= (np.median(tempDiff))
-        #logger.debug(np.std(tempDiff))
-
-        #Shift the magnitudes in the phot file by the zeropoint
-        for r in range(len(photFile[:,0])):
-            photFile[r,4]=photFile[r,4]+tempZP
-
-        file = Path(file)
-        #Save the calibrated photfiles to the calib directory
-        np.savetxt(calibPath / "{}.calibrated.{}".format(file.stem, file.suffix), photFile, delimiter=",", fmt='%0.8f')
-
-        #Look within photfile for ACTUAL usedcomps.csv and pull them out
-        lineCompUsed=[]
-        if compUsedFile.shape[0] ==3 and compUsedFile.size == 3:
-            lenloop=1
-        else:
-            lenloop=len(compUsedFile[:,0])
-
-        #logger.debug(compUsedFile.size)
-        for r in range(lenloop):
-            if compUsedFile.shape[0] ==3 and compUsedFile.size ==3:
-                compUsedCoord=SkyCoord(ra=compUsedFile[0]*u.degree,dec=compUsedFile[1]*u.degree)
-            else:
-                compUsedCoord=SkyCoord(ra=compUsedFile[r][0]*u.degree,dec=compUsedFile[r][1]*u.degree)
-            idx,d2d,d3d=compUsedCoord.match_to_catalog_sky(photCoords)
-            lineCompUsed.append(photFile[idx,4])
-
-        #logger.debug(lineCompUsed)
-        calibCompUsed.append(lineCompUsed)
-
+    # Files are independent of each other so are calibrated in parallel threads
+    with ThreadPoolExecutor() as executor:
+        calibrated = executor.map(lambda imgs: calibrate_photometry_file(parentPath / fileList[imgs], calibPath, calibStand, calibXyz, compUsedXyz, photFileArray[imgs], photTrees[imgs]), range(len(fileList)))
+        for imgs, compMags in enumerate(calibrated):
+            calibCompUsed[imgs]=compMags
 
     # Finalise calibcompsusedfile
     #logger.debug(calibCompUsed)
 
-    calibCompUsed=np.asarray(calibCompUsed)
     #logger.debug(calibCompUsed[0,:])
 
     finalCompUsedFile=[]
@@ -659,8 +551,8 @@ def find_comparisons_calibrated(filterCode, paths=None, max_magerr=0.05, stdMult
         sumStd.append(np.std(calibCompUsed[:,r]))
         #logger.debug(calibCompUsed[:,r])
         #logger.debug(np.std(calibCompUsed[:,r]))
-        if compUsedFile.shape[0] ==3  and compUsedFile.size ==3:
-            finalCompUsedFile.append([compUsedFile[0],compUsedFile[1],compUsedFile[2],np.median(calibCompUsed[:,r]),np.asarray(calibStands[0])[4]])
+        if compUsedFile.shape[0] ==1:
+            finalCompUsedFile.append([compUsedFile[r][0],compUsedFile[r][1],compUsedFile[r][2],np.median(calibCompUsed[:,r]),np.asarray(calibStands[0])[4]])
         else:
             finalCompUsedFile.append([compUsedFile[r][0],compUsedFile[r][1],compUsedFile[r][2],np.median(calibCompUsed[:,r]),np.std(calibCompUsed[:,r])])
 
@@ -687,3 +579,46 @@ def find_comparisons_calibrated(filterCode, paths=None, max_magerr=0.05, stdMult
     compFile = np.asarray(finalCompUsedFile)
     np.savetxt(parentPath / "calibCompsUsed.csv", compFile, delimiter=",", fmt='%0.8f')
     return compFile
+
+def calibrate_photometry_file(file, calibPath, calibStand, calibXyz, compUsedXyz, photFile=None, photTree=None):
+    '''
+    Shift the instrumental magnitudes of a photometry file onto the catalogue
+    zero point of the calibration standards and save it to calibPath.
+    photFile and photTree are the already loaded file and its KD-tree, if available
+
+    Returns
+    -------
+    compMags : array
+        Calibrated magnitude of each used comparison star in the file
+    '''
+    logger.debug(file)
+
+    #Get the phot file into memory, copying a cached one as it is changed in place
+    if photFile is None:
+        photFile = read_photometry_file(file)
+        photTree=sky_tree(photFile[:,0], photFile[:,1])
+    else:
+        photFile = photFile.copy()
+
+    #Convert the phot file into instrumental magnitudes
+    photFile[:,5]=1.0857 * (photFile[:,5]/photFile[:,4])
+    photFile[:,4]=-2.5*np.log10(photFile[:,4])
+
+    #Pull out the CalibStands out of each file
+    idx,sep=match_xyz(calibXyz, photTree)
+    tempDiff=calibStand[:,3]-photFile[idx,4]
+
+    #logger.debug(tempDiff)
+    tempZP= (np.median(tempDiff))
+    #logger.debug(np.std(tempDiff))
+
+    #Shift the magnitudes in the phot file by the zeropoint
+    photFile[:,4]+=tempZP
+
+    file = Path(file)
+    #Save the calibrated photfiles to the calib directory
+    np.savetxt(calibPath / "{}.calibrated.{}".format(file.stem, file.suffix), photFile, delimiter=",", fmt='%0.8f')
+
+    #Look within photfile for ACTUAL usedcomps.csv and pull them out
+    idx,sep=match_xyz(compUsedXyz, photTree)
+    return photFile[idx,4]
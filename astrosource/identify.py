@@ -1,41 +1,41 @@
 import numpy as np
-from astropy import units as u
 from astropy import wcs
-from astropy.coordinates import SkyCoord
 from astropy.io import fits
 import glob
 import sys
 import os
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
-from astrosource.utils import AstrosourceException
+from astrosource.utils import read_photometry_file, radec_to_xyz, sky_tree, match_xyz, AstrosourceException
 
 logger = logging.getLogger(__name__)
 
+# Header keywords (and keyword prefixes) which define the world coordinate transformation
+WCS_KEYWORDS = ('WCSAXES', 'CTYPE', 'CUNIT', 'CRVAL', 'CRPIX', 'CDELT', 'CROTA', 'CD', 'PC', 'PV', 'PS', 'LONPOLE', 'LATPOLE', 'RADESYS', 'RADECSYS', 'EQUINOX', 'EPOCH', 'A_', 'B_', 'AP_', 'BP_')
+WCS_CACHE_SIZE = 64
+_wcs_cache = {}
+
+# Character substitutions used to build file names from header values
+OBJECT_TRANSLATION = str.maketrans({'-':'d', '+':'p', '.':'d', ' ':None, '_':None, '=':'e', '(':None, ')':None, '<':None, '>':None, '/':None})
+DATE_TRANSLATION = str.maketrans('-:.', 'ddd')
+INSTRUMENT_TRANSLATION = str.maketrans({' ':None, '/':None, '-':None})
+
 def rename_data_file(prihdr):
 
     prihdrkeys = prihdr.keys()
 
     if any("OBJECT" in s for s in prihdrkeys):
-        objectTemp=prihdr['OBJECT'].replace('-','d').replace('+','p').replace('.','d').replace(' ','').replace('_','').replace('=','e').replace('(','').replace(')','').replace('<','').replace('>','').replace('/','')
+        objectTemp=prihdr['OBJECT'].translate(OBJECT_TRANSLATION)
     else:
         objectTemp="UNKNOWN"
 
-    if 'FILTER' in prihdr:
-        filterOne=(prihdr['FILTER'])
-    else:
-        filters = []
-        filters.append(prihdr['FILTER1'])
-        filters.append(prihdr['FILTER2'])
-        filters.append(prihdr['FILTER3'])
-        filter =list(set(filters))
-        filter.remove('air')
-        filterOne = filter[0]
+    filterOne = header_filter(prihdr)
 
     expTime=(str(prihdr['EXPTIME']).replace('.','d'))
-    dateObs=(prihdr['DATE'].replace('-','d').replace(':','d').replace('.','d'))
+    dateObs=(prihdr['DATE'].translate(DATE_TRANSLATION))
     airMass=(str(prihdr['AIRMASS']).replace('.','a'))
-    instruMe=(prihdr['INSTRUME']).replace(' ','').replace('/','').replace('-','')
+    instruMe=(prihdr['INSTRUME']).translate(INSTRUMENT_TRANSLATION)
 
     if (prihdr['MJD-OBS'] == 'UNKNOWN'):
         mjdObs = 'UNKNOWN'
@@ -45,29 +45,71 @@ def rename_data_file(prihdr):
 
     return newName
 
+def header_filter(prihdr):
+    '''
+    Filter the image was taken through, from FILTER or whichever of FILTER1-3 isn't 'air'
+    '''
+    if 'FILTER' in prihdr:
+        filterOne=(prihdr['FILTER'])
+    else:
+        filters = []
+        filters.append(prihdr['FILTER1'])
+        filters.append(prihdr['FILTER2'])
+        filters.append(prihdr['FILTER3'])
+        filter =list(set(filters))
+        filter.remove('air')
+        filterOne = filter[0]
+    return filterOne
+
 def export_photometry_files(filelist, indir, filetype='csv'):
+    '''
+    Extract the photometry from each image, returning the photometry files and the filter of each
+    '''
     phot_list = []
+    filter_list = []
     for f in filelist:
-        out = extract_photometry(f, indir)
+        out, filterOne = _extract_photometry(f, indir)
         phot_list.append(out)
-    return phot_list
+        filter_list.append(filterOne)
+    return phot_list, filter_list
 
 def extract_photometry(infile, parentPath, outfile=None):
-
-    hdulist = fits.open(infile)
-
-    if not outfile:
-        outfile = rename_data_file(hdulist[1].header)
-    outfile = parentPath / outfile
-    w = wcs.WCS(hdulist[1].header)
-    data = hdulist[2].data
-    xpixel = data['x']
-    ypixel = data['y']
-    ra, dec = w.wcs_pix2world(xpixel, ypixel, 1)
-    counts = data['flux']
-    countserr = data['fluxerr']
-    np.savetxt(outfile, np.transpose([ra, dec, xpixel, ypixel, counts, countserr]), delimiter=',')
-    return outfile
+    return _extract_photometry(infile, parentPath, outfile)[0]
+
+def _extract_photometry(infile, parentPath, outfile=None):
+    '''
+    extract_photometry, also returning the filter read from the header so it
+    doesn't have to be parsed back out of the file name
+    '''
+    # Only the table columns needed are read from the memory mapped file, and it is closed afterwards
+    with fits.open(infile, memmap=True, mode='readonly') as hdulist:
+        filterOne = header_filter(hdulist[1].header)
+        if not outfile:
+            outfile = rename_data_file(hdulist[1].header)
+        outfile = parentPath / outfile
+        w = header_wcs(hdulist[1].header)
+        data = hdulist[2].data
+        xpixel = data['x']
+        ypixel = data['y']
+        ra, dec = w.wcs_pix2world(xpixel, ypixel, 1)
+        counts = data['flux']
+        countserr = data['fluxerr']
+        photometry = np.column_stack([ra, dec, xpixel, ypixel, counts, countserr]).astype(np.float64)
+        np.savetxt(outfile, photometry, delimiter=',', fmt='%0.8f')
+        # Binary copy read in place of the csv by read_photometry_file
+        np.save(outfile.with_suffix('.npy'), photometry)
+    return outfile, filterOne
+
+def header_wcs(header):
+    '''
+    WCS for an image header, reusing the one built for an earlier image with the same WCS keywords
+    '''
+    key = tuple((card.keyword, card.value) for card in header.cards if card.keyword.startswith(WCS_KEYWORDS))
+    if key not in _wcs_cache:
+        if len(_wcs_cache) >= WCS_CACHE_SIZE:
+            _wcs_cache.clear()
+        _wcs_cache[key] = wcs.WCS(header)
+    return _wcs_cache[key]
 
 def gather_files(paths, filetype="fz"):
     # Get list of files
@@ -76,12 +118,16 @@ def gather_files(paths, filetype="fz"):
     if filetype not in ['fits','fit','fz']:
         # Assume we are not dealing with image files but photometry files
         phot_list = [f for f in filelist]
+        filters = set([os.path.basename(f).split('_')[1] for f in phot_list])
     else:
-        phot_list = export_photometry_files(filelist, paths['parent'])
+        # The filters are known from the image headers
+        phot_list, filter_list = export_photometry_files(filelist, paths['parent'])
+        filters = set(filter_list)
     if not phot_list:
         raise AstrosourceException("No files of type '.{}' found in {}".format(filetype, paths['parent']))
-
-    filters = set([os.path.basename(f).split('_')[1] for f in phot_list])
+    # The glob order depends on the file system, sorting (largest first, then by name) only
+    # makes the order of the files, and so of usedImages.txt, the same on every run
+    phot_list.sort(key=lambda f: (-os.path.getsize(f), str(f)))
 
     logger.debug("Filter Set: {}".format(filters))
     if len(filters) > 1:
@@ -134,22 +180,22 @@ def find_stars(targetStars, paths, fileList, acceptDistance=1.0, minimumCounts=1
     fileSizer=0
     logger.info("Finding image with most stars detected and reject ones with bad WCS")
     referenceFrame = None
+    # Files with good WCS are kept parsed so the second pass doesn't have to read them again
+    parsed = []
 
-    for file in fileList:
-        photFile = np.genfromtxt(file, dtype=float, delimiter=',')
-        if (( np.asarray(photFile[:,0]) > 360).sum() > 0) :
-            logger.debug("REJECT")
-            logger.debug(file)
-            fileList.remove(file)
-        elif (( np.asarray(photFile[:,1]) > 90).sum() > 0) :
+    # The pandas parser releases the GIL so the files are read in parallel threads
+    with ThreadPoolExecutor() as executor:
+        photFiles = list(executor.map(read_photometry_file, fileList))
+
+    for file, photFile in zip(fileList, photFiles):
+        if np.any(photFile[:,0] > 360) or np.any(photFile[:,1] > 90):
             logger.debug("REJECT")
             logger.debug(file)
-            fileList.remove(file)
         else:
+            parsed.append((file, photFile))
             # Sort through and find the largest file and use that as the reference file
             if photFile.size > fileSizer:
-                phottmparr = np.asarray(photFile)
-                if (( phottmparr[:,0] > 360).sum() == 0) and ( phottmparr[0][0] != 'null') and ( phottmparr[0][0] != 0.0) :
+                if ( photFile[0][0] != 'null') and ( photFile[0][0] != 0.0) :
                     referenceFrame = photFile
                     fileSizer = photFile.size
                     logger.debug("{} - {}".format(photFile.size, file))
@@ -157,68 +203,65 @@ def find_stars(targetStars, paths, fileList, acceptDistance=1.0, minimumCounts=1
         raise AstrosourceException("No suitable reference files found")
 
     logger.debug("Setting up reference Frame")
-    fileRaDec = SkyCoord(ra=referenceFrame[:,0]*u.degree, dec=referenceFrame[:,1]*u.degree)
 
     logger.debug("Removing stars with low or high counts")
-    rejectStars=[]
-    # Check star has adequate counts
-    for j in range(referenceFrame.shape[0]):
-        if ( referenceFrame[j][4] < minimumCounts or referenceFrame[j][4] > maximumCounts ):
-            rejectStars.append(int(j))
     logger.debug("Number of stars prior")
     logger.debug(referenceFrame.shape[0])
 
-    referenceFrame=np.delete(referenceFrame, rejectStars, axis=0)
+    # Check star has adequate counts
+    counts = referenceFrame[:,4]
+    referenceFrame = referenceFrame[~((counts < minimumCounts) | (counts > maximumCounts))]
 
     logger.debug("Number of stars post")
     logger.debug(referenceFrame.shape[0])
 
+    # Unit vectors of the reference stars. Stars missing from an image are dropped from
+    # keepStars and referenceFrame is only cut down once all the images are checked
+    refXyz = radec_to_xyz(referenceFrame[:,0], referenceFrame[:,1])
+    keepStars = np.ones(referenceFrame.shape[0], dtype=bool)
+    rejectStars = np.array([], dtype=np.intp)
+
     imgsize=imageFracReject * fileSizer # set threshold size
     rejStartCounter = 0
     imgReject = 0 # Number of images rejected due to high rejection rate
     loFileReject = 0 # Number of images rejected due to too few stars in the photometry file
     wcsFileReject=0
-    for file in fileList:
+    # The reference stars are fixed, so every image is matched against them independently in
+    # parallel threads. Only the separation of each reference star is kept, not the KD-tree
+    with ThreadPoolExecutor() as executor:
+        imageSeps = list(executor.map(lambda parsedFile: match_xyz(refXyz, sky_tree(parsedFile[1][:,0], parsedFile[1][:,1]))[1], parsed))
+
+    for (file, photFile), sep in zip(parsed, imageSeps):
         rejStartCounter = rejStartCounter +1
-        photFile = np.genfromtxt(file, dtype=float, delimiter=',')
-        # DUP fileRaDec = SkyCoord(ra=photFile[:,0]*u.degree, dec=photFile[:,1]*u.degree)
 
         logger.debug('Image Number: ' + str(rejStartCounter))
         logger.debug(file)
         logger.debug("Image threshold size: "+str(imgsize))
         logger.debug("Image catalogue size: "+str(photFile.size))
         if photFile.size > imgsize and photFile.size > 7:
-            phottmparr = np.asarray(photFile)
-            if (( phottmparr[:,0] > 360).sum() == 0) and ( phottmparr[0][0] != 'null') and ( phottmparr[0][0] != 0.0) :
+            if ( photFile[0][0] != 'null') and ( photFile[0][0] != 0.0) :
 
                 # Checking existance of stars in all photometry files
-                rejectStars=[] # A list to hold what stars are to be rejected
-
                 # Find whether star in reference list is in this phot file, if not, reject star.
-                for j in range(referenceFrame.shape[0]):
-                    photRAandDec = SkyCoord(ra = photFile[:,0]*u.degree, dec = photFile[:,1]*u.degree)
-                    testStar = SkyCoord(ra = referenceFrame[j][0]*u.degree, dec = referenceFrame[j][1]*u.degree)
-                    # This is the only line in the whole package which requires scipy
-                    idx, d2d, d3d = testStar.match_to_catalog_sky(photRAandDec)
-                    if (d2d.arcsecond > acceptDistance):
-                        #"No Match! Nothing within range."
-                        rejectStars.append(int(j))
-
+                #"No Match! Nothing within range."
+                rejectStars = np.flatnonzero(keepStars & (sep > acceptDistance))
 
+            remainingStars = np.count_nonzero(keepStars)
             # if the rejectstar list is not empty, remove the stars from the reference List
-            if rejectStars != []:
+            if rejectStars.size:
 
-                if not (((len(rejectStars) / referenceFrame.shape[0]) > starFracReject) and rejStartCounter > rejectStart):
-                    referenceFrame = np.delete(referenceFrame, rejectStars, axis=0)
+                if not (((rejectStars.size / remainingStars) > starFracReject) and rejStartCounter > rejectStart):
+                    keepStars[rejectStars] = False
+                    remainingStars = remainingStars - rejectStars.size
                     logger.debug('**********************')
-                    logger.debug('Stars Removed  : ' +str(len(rejectStars)))
-                    logger.debug('Remaining Stars: ' +str(referenceFrame.shape[0]))
+                    logger.debug('Stars Removed  : ' +str(rejectStars.size))
+                    logger.debug('Remaining Stars: ' +str(remainingStars))
                     logger.debug('**********************')
                     usedImages.append(file)
                 else:
                     logger.debug('**********************')
                     logger.debug('Image Rejected due to too high a fraction of rejected stars')
-                    logger.debug(len(rejectStars) / referenceFrame.shape[0])
+                    logger.debug(rejectStars.size / remainingStars)
                     logger.debug('**********************')
                     imgReject=imgReject+1
             else:
@@ -228,11 +271,11 @@ def find_stars(targetStars, paths, fileList, acceptDistance=1.0, minimumCounts=1
                 usedImages.append(file)
 
             # If we have removed all stars, we have failed!
-            if (referenceFrame.shape[0]==0):
+            if (remainingStars==0):
                 logger.error("Problem file - {}".format(file))
                 raise AstrosourceException("All Stars Removed. Try removing problematic files or raising the imageFracReject")
 
-            if (referenceFrame.shape[0]< minCompStars):
+            if (remainingStars< minCompStars):
                 logger.error("Problem file - {}".format(file))
                 raise AstrosourceException("There are fewer than the requested number of Comp Stars. Try removing problematic files or raising the imageFracReject")
 
@@ -247,10 +290,10 @@ def find_stars(targetStars, paths, fileList, acceptDistance=1.0, minimumCounts=1
             logger.error('**********************')
             loFileReject=loFileReject+1
 
+    referenceFrame = referenceFrame[keepStars]
+
     # Construct the output file containing candidate comparison stars
-    outputComps=[]
-    for j in range (referenceFrame.shape[0]):
-        outputComps.append([referenceFrame[j][0],referenceFrame[j][1]])
+    outputComps = referenceFrame[:,:2]
 
     logger.debug("These are the identified common stars of sufficient brightness that are in every image")
     logger.debug(outputComps)
@@ -4,6 +4,7 @@ import sys
 import logging
 
 from numpy import array
+from astropy.utils import iers
 
 from astrosource.identify import find_stars, gather_files
 from astrosource.comparison import find_comparisons, find_comparisons_calibrated
@@ -19,6 +20,9 @@ from astrosource.utils import get_targets, folder_setup, AstrosourceException, c
 logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# All coordinates are ICRS so Earth orientation tables are never needed, don't stall trying to download them
+iers.conf.auto_download = False
+
 
 @click.command()
 @click.option('--full', is_flag=True)
@@ -60,14 +64,16 @@ def main(full, stars, comparison, calc, calib, phot, plot, detrend, eebls, indir
 
         if full or stars:
             usedimages = find_stars(targets, paths, filelist)
+        # Photometry loaded when finding comparisons is reused for the calibration
+        comparisonCache = {}
         if full or comparison and not calib:
-            find_comparisons(parentPath)
+            find_comparisons(parentPath, cache=comparisonCache)
         if full or comparison and calib:
             # Check that it is a filter that can actually be calibrated - in the future I am considering calibrating w against V to give a 'rough V' calibration, but not for now.
             if filtercode=='B' or filterCode=='V' or filtercode=='up' or filtercode=='gp' or filtercode=='rp' or filtercode=='ip' or filtercode=='zs':
-                find_comparisons_calibrated(filtercode, paths)
+                find_comparisons_calibrated(filtercode, paths, cache=comparisonCache)
             else:
-                find_comparisons(parentPath)
+                find_comparisons(parentPath, cache=comparisonCache)
         if full or calc:
             calculate_curves(targets, parentPath=parentPath)
         if full or phot:
@@ -0,0 +1,85 @@
+import numpy
+import os
+
+from astrosource.analyse import photometric_calculations, variability_statistics
+
+
+def synthetic_field(tmp_path, nImages=18, nStars=12, targetStar=5, comps=(0, 1, 2, 3)):
+    # Photometry files of the same field, named like the renamed image files so the
+    # date and airmass can be read from them, along with usedImages.txt and compsUsed.csv
+    rng = numpy.random.default_rng(7)
+    ra = 154.9 + rng.uniform(-0.05, 0.05, nStars)
+    dec = -9.8 + rng.uniform(-0.05, 0.05, nStars)
+    brightness = rng.uniform(5e4, 5e5, nStars)
+    fileList = []
+    counts = numpy.empty((nImages, nStars))
+    for i in range(nImages):
+        counts[i] = brightness * rng.normal(1, 0.01, nStars)
+        photFile = numpy.column_stack([ra, dec, rng.uniform(0, 1000, nStars), rng.uniform(0, 1000, nStars), counts[i], numpy.sqrt(counts[i])])
+        fileName = tmp_path / "Field_V_20d0_2019d01d{:02d}_1a2{}_24585{:02d}d5_kb95.csv".format(i+1, i, i)
+        numpy.savetxt(fileName, photFile, delimiter=',', fmt='%0.8f')
+        fileList.append(str(fileName))
+    (tmp_path / "usedImages.txt").write_text("\n".join(fileList) + "\n")
+    compsUsed = numpy.column_stack([ra[list(comps)], dec[list(comps)], numpy.full(len(comps), 0.01)])
+    numpy.savetxt(tmp_path / "compsUsed.csv", compsUsed, delimiter=',', fmt='%0.8f')
+    (tmp_path / "outputcats").mkdir()
+    paths = {'parent': tmp_path, 'outcatPath': tmp_path / "outputcats"}
+    target = numpy.array([[ra[targetStar], dec[targetStar], 0, 0]])
+    return paths, target, fileList
+
+def test_photometric_calculations(tmp_path):
+    paths, target, fileList = synthetic_field(tmp_path)
+    outputPhot = photometric_calculations(target, paths)
+    assert outputPhot.shape == (18, 6 + 8 + 4)
+    assert (paths['outcatPath'] / "doerPhot_V1.csv").exists()
+    photFiles = [numpy.loadtxt(f, delimiter=',') for f in fileList]
+    ensemble = numpy.array([photFile[:4,4].sum() for photFile in photFiles])
+    counts = numpy.array([photFile[5,4] for photFile in photFiles])
+    # Date and airmass from the file names, then ensemble counts, differential magnitude and target counts
+    assert numpy.allclose(outputPhot[:,6], [2458500.5 + i for i in range(18)])
+    assert numpy.allclose(outputPhot[:,7], [float("1.2{}".format(i)) for i in range(18)])
+    assert numpy.allclose(outputPhot[:,8], ensemble)
+    assert numpy.allclose(outputPhot[:,10], -2.5*numpy.log10(counts/ensemble))
+    assert numpy.allclose(outputPhot[:,12], counts)
+    assert numpy.allclose(outputPhot[:,14:], [photFile[:4,4] for photFile in photFiles])
+
+def test_photometric_calculations_negative_counts(tmp_path):
+    paths, target, fileList = synthetic_field(tmp_path)
+    # A negative flux for the target in one image has no magnitude, so that image is
+    # dropped rather than stopping the run
+    photFile = numpy.loadtxt(fileList[7], delimiter=',')
+    photFile[5,4] = -50.0
+    numpy.savetxt(fileList[7], photFile, delimiter=',', fmt='%0.8f')
+    outputPhot = photometric_calculations(target, paths)
+    assert outputPhot.shape[0] == 17
+    assert numpy.isfinite(outputPhot[:,10]).all()
+    assert -50.0 not in outputPhot[:,12]
+
+def clipped_statistics(diffMagHolder):
+    # The original per-target loop: reject 4 sigma outliers until none are left
+    diffMagHolder = diffMagHolder[~numpy.isnan(diffMagHolder)]
+    while True:
+        stdVar = numpy.std(diffMagHolder)
+        avgVar = numpy.average(diffMagHolder)
+        starReject = (diffMagHolder > avgVar+(4*stdVar)) | (diffMagHolder < avgVar-(4*stdVar))
+        diffMagHolder = diffMagHolder[~starReject]
+        if not starReject.any():
+            break
+    return numpy.median(diffMagHolder), numpy.std(diffMagHolder), diffMagHolder.shape[0]
+
+def test_variability_statistics():
+    rng = numpy.random.default_rng(3)
+    diffMags = rng.normal(1.5, 0.02, (4, 40))
+    # An outlier, measurements missing from some images and a target never measured
+    diffMags[1,7] = 3.0
+    diffMags[2,::3] = numpy.nan
+    diffMags[2,10] = 0.5
+    diffMags[3] = numpy.nan
+    median, std, nobs = variability_statistics(diffMags)
+    assert list(nobs) == [40, 39, 25, 0]
+    for q in range(3):
+        expected = clipped_statistics(diffMags[q])
+        assert numpy.isclose(median[q], expected[0], rtol=0, atol=1e-12)
+        assert numpy.isclose(std[q], expected[1], rtol=0, atol=1e-12)
+        assert nobs[q] == expected[2]
+    assert numpy.isnan(median[3]) and numpy.isnan(std[3])
@@ -1,9 +1,13 @@
 from astropy.io import fits
+from astropy.coordinates import SkyCoord
+from astropy.table import Table
 import numpy
 import os
+import shutil
 from pathlib import Path
 
-from astrosource.comparison import find_comparisons, read_data_files, find_reference_frame
+from astrosource import comparison
+from astrosource.comparison import find_comparisons, read_data_files, find_reference_frame, query_vizier
 
 
 TEST_PATH_PARENT = Path(os.path.dirname(__file__)) / 'test_files'
@@ -28,15 +32,36 @@ def test_read_data_files():
     assert 'screenedComps.csv' in files
     assert 'targetstars.csv' in files
     compFile, photFileArray, fileList = read_data_files(TEST_PATHS['parent'])
-    referenceFrame, fileRaDec = find_reference_frame(photFileArray)
+    referenceFrame = find_reference_frame(photFileArray)
     assert list(referenceFrame[0]) == [154.7583434, -9.6660181000000005, 271.47230000000002, 23.331099999999999, 86656.100000000006, 319.22829999999999]
-    assert (fileRaDec[0].ra.degree, fileRaDec[0].dec.degree) == ( 154.7583434,  -9.6660181)
     assert len(referenceFrame) == 227
-    assert len(fileRaDec) == 227
 
 def test_comparison():
+    # Remove catalogue queries cached by an earlier run so VSX is really queried
+    catalogCache = TEST_PATHS['parent'] / 'catalogcache'
+    shutil.rmtree(catalogCache, ignore_errors=True)
     # All files are present so we are ready to continue
-    outfile, num_cands = find_comparisons(TEST_PATHS['parent'])
+    try:
+        outfile, num_cands = find_comparisons(TEST_PATHS['parent'])
+    finally:
+        shutil.rmtree(catalogCache, ignore_errors=True)
 
     assert outfile == TEST_PATHS['parent'] / "compsUsed.csv"
     assert num_cands == 11
+
+def test_query_vizier_cache(tmp_path, monkeypatch):
+    queries = []
+    def query_region(coord, radius, catalog):
+        queries.append(catalog)
+        return {'B/vsx/vsx': Table({'RAJ2000': [154.9], 'DEJ2000': [-9.8]})}
+    monkeypatch.setattr(comparison.Vizier, 'query_region', query_region)
+
+    coord = SkyCoord(154.9, -9.8, unit='deg')
+    first = query_vizier(tmp_path, coord, 'VSX', 'B/vsx/vsx')
+    # A repeat of the same query is read from the cache without querying Vizier
+    second = query_vizier(tmp_path, coord, 'VSX', 'B/vsx/vsx')
+    assert queries == ['VSX']
+    assert list(second['RAJ2000']) == list(first['RAJ2000'])
+    # A different field is not
+    query_vizier(tmp_path, SkyCoord(10.0, 10.0, unit='deg'), 'VSX', 'B/vsx/vsx')
+    assert queries == ['VSX', 'VSX']
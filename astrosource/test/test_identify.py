@@ -4,7 +4,7 @@ import os
 from pathlib import Path
 
 from astrosource.identify import (rename_data_file, export_photometry_files,
-    extract_photometry, gather_files, find_stars)
+    extract_photometry, gather_files, find_stars, header_wcs)
 
 
 TEST_PATH_PARENT = Path(os.path.dirname(__file__)) / 'test_files'
@@ -56,6 +56,32 @@ def test_rename_nomjd():
     exp_name = "M1_ip_20d0_2019d01d25T15d54d10d861857_1a6_UNKNOWN_kb92.csv"
     assert name == exp_name
 
+def wcs_header(crval1, radecsys='ICRS'):
+    header = fits.Header()
+    header['CTYPE1'] = 'RA---TAN'
+    header['CTYPE2'] = 'DEC--TAN'
+    header['CRVAL1'] = crval1
+    header['CRVAL2'] = 50.0
+    header['CRPIX1'] = 762.0
+    header['CRPIX2'] = 510.0
+    header['CD1_1'] = -0.0003
+    header['CD1_2'] = 0.0
+    header['CD2_1'] = 0.0
+    header['CD2_2'] = 0.0003
+    header['RADECSYS'] = radecsys
+    header['EXPTIME'] = 20.0
+    return header
+
+def test_header_wcs():
+    w = header_wcs(wcs_header(117.0))
+    # Only the WCS keywords decide whether the cached WCS is reused
+    other = wcs_header(117.0)
+    other['EXPTIME'] = 30.0
+    assert header_wcs(other) is w
+    assert header_wcs(wcs_header(117.5)) is not w
+    assert header_wcs(wcs_header(117.0, radecsys='FK5')) is not w
+    assert header_wcs(wcs_header(117.5)).wcs.crval[0] == 117.5
+
 def test_extract_photometry(tmp_path):
     # tmp_path is a Path object for a temporary directory
     infile = TEST_PATHS['parent'] / 'photometry_test.fits'
@@ -77,6 +103,7 @@ def test_gather_files():
     # Clean up
     for tf in test_files:
         os.remove(tf)
+        os.remove(tf.with_suffix('.npy'))
 
 def test_find_stars():
     target = [[117.0269708, 50.2258111, 0,0]]
@@ -93,6 +120,8 @@ def test_find_stars():
     (TEST_PATHS['parent'] / 'usedImages.txt').unlink()
     test_files = ['XOd2_ip_22d293_2017d01d04_1a0899013_57757d0522793000_kb29.csv',
                   'XOd2_ip_22d284_2017d01d04_1a089113_57757d0532642000_kb29.csv',
+                  'XOd2_ip_22d293_2017d01d04_1a0899013_57757d0522793000_kb29.npy',
+                  'XOd2_ip_22d284_2017d01d04_1a089113_57757d0532642000_kb29.npy',
                   'screenedComps.csv',
                   'targetstars.csv']
     for tf in test_files:
@@ -0,0 +1,149 @@
+from astropy.coordinates import SkyCoord
+import numpy
+import os
+
+from astrosource.utils import (radec_to_xyz, sky_tree, match_radec, match_xyz, stars_within,
+    photometry_files_to_array, load_photometry_cache, read_photometry_file)
+
+
+def random_sky(rng, n):
+    # Uniform over the whole sphere
+    ra = rng.uniform(0, 360, n)
+    dec = numpy.degrees(numpy.arcsin(rng.uniform(-1, 1, n)))
+    return ra, dec
+
+def test_radec_to_xyz():
+    xyz = radec_to_xyz(numpy.array([0.0, 90.0, 45.0]), numpy.array([0.0, 0.0, 90.0]))
+    assert numpy.allclose(xyz, [[1, 0, 0], [0, 1, 0], [0, 0, 1]])
+    out = numpy.empty((3, 3))
+    assert radec_to_xyz(numpy.array([0.0, 90.0, 45.0]), numpy.array([0.0, 0.0, 90.0]), out=out) is out
+    assert numpy.allclose(out, xyz)
+
+def test_match_radec_skycoord():
+    rng = numpy.random.default_rng(42)
+    catRa, catDec = random_sky(rng, 2000)
+    ra, dec = random_sky(rng, 500)
+    idx, sep = match_radec(ra, dec, sky_tree(catRa, catDec))
+
+    catalogue = SkyCoord(catRa, catDec, unit='deg')
+    skyIdx, skySep, _ = SkyCoord(ra, dec, unit='deg').match_to_catalog_sky(catalogue)
+    assert numpy.array_equal(idx, skyIdx)
+    assert numpy.allclose(sep, skySep.arcsecond, rtol=0, atol=1e-8)
+
+def test_match_xyz_same_as_match_radec():
+    rng = numpy.random.default_rng(1)
+    tree = sky_tree(*random_sky(rng, 100))
+    ra, dec = random_sky(rng, 10)
+    idx, sep = match_xyz(radec_to_xyz(ra, dec), tree)
+    radecIdx, radecSep = match_radec(ra, dec, tree)
+    assert numpy.array_equal(idx, radecIdx)
+    assert numpy.array_equal(sep, radecSep)
+
+def test_match_radec_scalar():
+    tree = sky_tree(numpy.array([10.0, 20.0, 30.0]), numpy.array([-5.0, 0.0, 5.0]))
+    idx, sep = match_radec(20.0, 1.0/3600, tree)
+    assert numpy.ndim(idx) == 0
+    assert idx == 1
+    assert abs(sep - 1.0) < 1e-6
+
+def test_stars_within():
+    # Stars 0, 0.999 and 1.001 arcseconds north of the origin, and one far away
+    tree = sky_tree(numpy.array([0.0, 0.0, 0.0, 180.0]), numpy.array([0.0, 0.999/3600, 1.001/3600, 0.0]))
+    assert list(stars_within(0.0, 0.0, tree, 1.0)) == [0, 1]
+    assert list(stars_within(0.0, 0.0, tree, 1.002)) == [0, 1, 2]
+    # Stars near more than one position are only returned once
+    assert list(stars_within(numpy.array([0.0, 0.0, 180.0]), numpy.array([0.0, 0.0, 0.0]), tree, 1.0)) == [0, 1, 3]
+
+def test_stars_within_empty_and_nan():
+    tree = sky_tree(numpy.array([0.0, 1.0]), numpy.array([0.0, 1.0]))
+    empty = stars_within(numpy.array([]), numpy.array([]), tree, 5.0)
+    assert empty.size == 0
+    assert empty.dtype == numpy.intp
+    # Positions which aren't finite are ignored
+    assert stars_within(numpy.array([numpy.nan, 0.0]), numpy.array([0.0, numpy.nan]), tree, 5.0).size == 0
+    assert list(stars_within(numpy.array([1.0, numpy.nan]), numpy.array([1.0, 0.0]), tree, 5.0)) == [1]
+
+def photometry_setup(tmp_path):
+    # Two photometry files listed in usedImages.txt, and the cache stacked from them
+    fileList = []
+    for i, rows in enumerate([3, 5]):
+        photFile = tmp_path / "image{}.csv".format(i)
+        numpy.savetxt(photFile, numpy.arange(rows*6, dtype=float).reshape(rows, 6) + i, delimiter=',')
+        fileList.append(str(photFile))
+    (tmp_path / "usedImages.txt").write_text("\n".join(fileList) + "\n")
+    photFileArray, offsets, fileList = photometry_files_to_array(tmp_path)
+    cacheFile = tmp_path / "photCache.npz"
+    # Make every input file clearly older than the cache
+    cacheTime = os.path.getmtime(cacheFile)
+    for f in fileList + [tmp_path / "usedImages.txt"]:
+        os.utime(f, (cacheTime - 10, cacheTime - 10))
+    return cacheFile, fileList, photFileArray, offsets
+
+def test_photometry_cache_reused(tmp_path):
+    cacheFile, fileList, photFileArray, offsets = photometry_setup(tmp_path)
+    assert list(offsets) == [0, 3, 8]
+    cachedArray, cachedOffsets = load_photometry_cache(cacheFile, fileList)
+    assert numpy.array_equal(cachedArray, photFileArray)
+    assert numpy.array_equal(cachedOffsets, offsets)
+    # The files aren't read again while the cache is up to date
+    numpy.savetxt(fileList[0], numpy.zeros((3, 6)), delimiter=',')
+    os.utime(fileList[0], (os.path.getmtime(cacheFile) - 10, os.path.getmtime(cacheFile) - 10))
+    reloaded, reloadedOffsets, reloadedList = photometry_files_to_array(tmp_path)
+    assert numpy.array_equal(reloaded, photFileArray)
+
+def test_photometry_cache_missing(tmp_path):
+    cacheFile, fileList, photFileArray, offsets = photometry_setup(tmp_path)
+    cacheFile.unlink()
+    assert load_photometry_cache(cacheFile, fileList) is None
+
+def test_photometry_cache_used_images_newer(tmp_path):
+    cacheFile, fileList, photFileArray, offsets = photometry_setup(tmp_path)
+    newer = os.path.getmtime(cacheFile) + 10
+    os.utime(tmp_path / "usedImages.txt", (newer, newer))
+    assert load_photometry_cache(cacheFile, fileList) is None
+
+def test_photometry_cache_photometry_newer(tmp_path):
+    cacheFile, fileList, photFileArray, offsets = photometry_setup(tmp_path)
+    newer = os.path.getmtime(cacheFile) + 10
+    os.utime(fileList[1], (newer, newer))
+    assert load_photometry_cache(cacheFile, fileList) is None
+    # and the changed file is read again
+    numpy.savetxt(fileList[1], numpy.zeros((2, 6)), delimiter=',')
+    os.utime(fileList[1], (newer, newer))
+    reloaded, reloadedOffsets, reloadedList = photometry_files_to_array(tmp_path)
+    assert list(reloadedOffsets) == [0, 3, 5]
+
+def test_photometry_cache_different_files(tmp_path):
+    cacheFile, fileList, photFileArray, offsets = photometry_setup(tmp_path)
+    assert load_photometry_cache(cacheFile, fileList[:1]) is None
+    assert load_photometry_cache(cacheFile, fileList[::-1]) is None
+
+def binary_setup(tmp_path):
+    # A csv file and a binary copy holding different values, so it is clear which was read
+    csvFile = tmp_path / "image.csv"
+    numpy.savetxt(csvFile, numpy.ones((4, 6)), delimiter=',')
+    binaryFile = tmp_path / "image.npy"
+    numpy.save(binaryFile, numpy.full((4, 6), 2.0))
+    return csvFile, binaryFile
+
+def test_read_photometry_binary_copy(tmp_path):
+    csvFile, binaryFile = binary_setup(tmp_path)
+    csvTime = os.path.getmtime(csvFile)
+    os.utime(binaryFile, (csvTime + 10, csvTime + 10))
+    assert numpy.array_equal(read_photometry_file(csvFile), numpy.full((4, 6), 2.0))
+    # A copy written at the same time as the csv is still used
+    os.utime(binaryFile, (csvTime, csvTime))
+    assert numpy.array_equal(read_photometry_file(str(csvFile)), numpy.full((4, 6), 2.0))
+
+def test_read_photometry_stale_binary_copy(tmp_path):
+    csvFile, binaryFile = binary_setup(tmp_path)
+    csvTime = os.path.getmtime(csvFile)
+    os.utime(binaryFile, (csvTime - 10, csvTime - 10))
+    assert numpy.array_equal(read_photometry_file(csvFile), numpy.ones((4, 6)))
+
+def test_read_photometry_csv_only(tmp_path):
+    csvFile, binaryFile = binary_setup(tmp_path)
+    binaryFile.unlink()
+    photFile = read_photometry_file(csvFile)
+    assert photFile.dtype == numpy.float64
+    assert numpy.array_equal(photFile, numpy.ones((4, 6)))
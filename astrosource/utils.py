@@ -1,7 +1,10 @@
 import numpy as np
+import pandas as pd
 import os
 import shutil
 import click
+from concurrent.futures import ThreadPoolExecutor
+from scipy.spatial import cKDTree
 
 class Mutex(click.Option):
     def __init__(self, *args, **kwargs):
@@ -28,14 +31,14 @@ class AstrosourceException(Exception):
 
 
 def cleanup(parentPath):
-    folders = ['calibcats', 'periods', 'checkplots', 'eelbs', 'outputcats','outputplots','trimcats']
+    folders = ['calibcats', 'periods', 'checkplots', 'eelbs', 'outputcats','outputplots','trimcats', 'catalogcache']
     for fd in folders:
         if (parentPath / fd).exists():
             shutil.rmtree(parentPath / fd)
 
     files = ['calibCompsUsed.csv', 'calibStands.csv', 'compsUsed.csv','screenedComps.csv', \
      'starVariability.csv', 'stdComps.csv', 'usedImages.txt', 'LightcurveStats.txt', \
-     'periodEstimates.txt','calibrationErrors.txt']
+     'periodEstimates.txt','calibrationErrors.txt', 'photCache.npz']
 
     for fname in files:
         if (parentPath / fname).exists():
@@ -61,23 +64,161 @@ def folder_setup(parentPath=None):
     return paths
 
 def photometry_files_to_array(parentPath):
+    '''
+    Load the photometry files listed in usedImages.txt
+
+    The rows of every file are stacked into one contiguous array, the rows of
+    image i being photFileArray[offsets[i]:offsets[i+1]]
+
+    Returns
+    -------
+    photFileArray, offsets, fileList
+    '''
     # Load in list of used files
     fileList=[]
     with open(parentPath / "usedImages.txt", "r") as f:
       for line in f:
         fileList.append(line.strip())
 
+    # Reuse the cached arrays if no photometry file has changed since they were stacked
+    cacheFile = parentPath / "photCache.npz"
+    cached = load_photometry_cache(cacheFile, fileList)
+
     # LOAD Phot FILES INTO LIST
-    photFileArray=[]
-    for file in fileList:
-        loadPhot=np.genfromtxt(file, dtype=float, delimiter=',')
-        if loadPhot.shape[1] > 6:
-            loadPhot=np.delete(loadPhot,6,1)
-            loadPhot=np.delete(loadPhot,6,1)
-        photFileArray.append(loadPhot)
-    photFileArray=np.asarray(photFileArray)
-
-    return photFileArray, fileList
+    if cached is None:
+        photFiles=[]
+        for file in fileList:
+            # Only the first six columns are used, calibrated files carry two more
+            photFiles.append(read_photometry_file(file)[:,:6])
+        offsets=np.zeros(len(photFiles)+1, dtype=np.intp)
+        offsets[1:]=np.cumsum([photFile.shape[0] for photFile in photFiles])
+        photFileArray=np.empty((offsets[-1], photFiles[0].shape[1]), dtype=np.float64)
+        for i, photFile in enumerate(photFiles):
+            photFileArray[offsets[i]:offsets[i+1]]=photFile
+        np.savez(cacheFile, photFileArray=photFileArray, offsets=offsets, fileList=np.array(fileList))
+    else:
+        photFileArray, offsets = cached
+
+    return photFileArray, offsets, fileList
+
+def read_photometry_file(file):
+    '''
+    Read a comma separated photometry file into a 2D float array, using the pandas C parser
+
+    The binary copy written alongside by extract_photometry is loaded instead
+    when it is at least as new as the csv file
+    '''
+    binaryFile = os.path.splitext(file)[0] + '.npy'
+    if os.path.exists(binaryFile) and os.path.getmtime(binaryFile) >= os.path.getmtime(file):
+        return np.load(binaryFile)
+    return pd.read_csv(file, header=None, dtype=np.float64).to_numpy()
+
+def load_photometry_cache(cacheFile, fileList):
+    '''
+    Load the stacked photometry and offsets stored by photometry_files_to_array
+
+    Returns None if there is no cache, or it is older than usedImages.txt or
+    any of the photometry files, or it was built from a different file list.
+    '''
+    if not cacheFile.exists():
+        return None
+    cacheTime = cacheFile.stat().st_mtime
+    if (cacheFile.parent / "usedImages.txt").stat().st_mtime > cacheTime:
+        return None
+    if any(os.path.getmtime(file) > cacheTime for file in fileList):
+        return None
+    with np.load(cacheFile) as cache:
+        if list(cache['fileList']) != fileList:
+            return None
+        return cache['photFileArray'], cache['offsets']
+
+def radec_to_xyz(ra, dec, out=None):
+    '''
+    Convert RA and Dec in decimal degrees to unit vectors on the celestial sphere
+
+    The components are written straight into out, an array of shape (..., 3),
+    if it is given, otherwise a new array is returned
+    '''
+    ra = np.radians(ra)
+    dec = np.radians(dec)
+    if out is None:
+        out = np.empty(np.shape(ra) + (3,))
+    cosDec = np.cos(dec)
+    np.multiply(cosDec, np.cos(ra), out=out[...,0])
+    np.multiply(cosDec, np.sin(ra), out=out[...,1])
+    np.sin(dec, out=out[...,2])
+    return out
+
+def sky_tree(ra, dec):
+    '''
+    Build a KD-tree of catalogue positions (decimal degrees) for use with match_radec
+    '''
+    return cKDTree(radec_to_xyz(ra, dec))
+
+def match_radec(ra, dec, tree, workers=1):
+    '''
+    Find the nearest catalogue star to each position
+
+    This is the same nearest neighbour search as SkyCoord.match_to_catalog_sky,
+    done directly on unit vectors as all coordinates here are ICRS degrees.
+
+    Parameters
+    ----------
+    ra, dec : float or array
+            Positions to match in decimal degrees
+    tree : cKDTree
+            Catalogue built with sky_tree
+    workers : int
+            Number of threads to split the queries over, -1 uses all cores.
+            Only worthwhile for large numbers of positions
+
+    Returns
+    -------
+    idx : int or array
+            Index of the nearest catalogue star
+    sep : float or array
+            Separation from that star in arcseconds
+    '''
+    return match_xyz(radec_to_xyz(ra, dec), tree, workers)
+
+def match_xyz(xyz, tree, workers=1):
+    '''
+    match_radec for positions already converted with radec_to_xyz, so the
+    conversion is done once when the same positions are matched against many catalogues
+    '''
+    chord, idx = tree.query(xyz, workers=workers)
+    sep = np.degrees(2*np.arcsin(np.minimum(chord/2, 1.0))) * 3600
+    return idx, sep
+
+def image_trees(photFileArray):
+    '''
+    KD-tree of the stars in each photometry file, for reuse in every catalogue match
+    '''
+    return [sky_tree(photFile[:,0], photFile[:,1]) for photFile in photFileArray]
+
+def match_comparisons(compFile, photTrees):
+    '''
+    Row of the nearest star to each comparison in each image, as an images x comparisons array
+    '''
+    compIdx = np.empty((len(photTrees), compFile.shape[0]), dtype=np.intp)
+    compXyz = radec_to_xyz(compFile[:,0], compFile[:,1])
+    # The tree queries release the GIL so the images are matched in parallel threads
+    with ThreadPoolExecutor() as executor:
+        for imgs, (idx, sep) in enumerate(executor.map(lambda photTree: match_xyz(compXyz, photTree), photTrees)):
+            compIdx[imgs] = idx
+    return compIdx
+
+def stars_within(ra, dec, tree, distance):
+    '''
+    Indices of every catalogue star within distance (arcseconds) of any of the
+    positions, found in one radius search rather than a nearest match per position
+    '''
+    xyz = np.atleast_2d(radec_to_xyz(ra, dec))
+    xyz = xyz[np.isfinite(xyz).all(axis=1)]
+    # Chord length between unit vectors separated by the distance
+    radius = 2*np.sin(np.radians(distance/3600)/2)
+    near = tree.query_ball_point(xyz, r=radius)
+    return np.unique(np.array([i for stars in near for i in stars], dtype=np.intp))
 
 def get_targets(targetfile):
     targets = np.genfromtxt(targetfile, dtype=float, delimiter=',')